@@ -0,0 +1,85 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Headless replay of crop boxes. Nothing here may import tkinter so that it
+# runs on machines without a display.
+
+import os
+import json
+import logging
+import concurrent.futures
+import cropper
+import exporter
+import manifest
+
+logger = logging.getLogger("cropall")
+
+
+def load_manifest(path):
+    """Reads a JSON object mapping image filenames, relative to the input
+    folder, to [left, upper, right, lower] crop boxes. A cropall_manifest.jsonl
+    from an interactive session can be given instead."""
+    if path.suffix == ".jsonl":
+        return manifest.Manifest(path.parent, path).boxes()
+    with open(path) as filehandle:
+        mapping = json.load(filehandle)
+    if not isinstance(mapping, dict):
+        raise ValueError("Expected a filename to crop box mapping in {}".format(path))
+    boxes = {}
+    for filename, box in mapping.items():
+        if len(box) != 4 or box[2] <= box[0] or box[3] <= box[1]:
+            raise ValueError("Invalid crop box {} for {}".format(box, filename))
+        boxes[filename] = [int(x) for x in box]
+    return boxes
+
+
+def run(config, input_folder, output_folder, boxes, workers=None, force=False):
+    """Crops and resizes all images in boxes using every core. Existing
+    outputs are skipped if confirm_overwrite is set, and images already
+    exported with the same source, box and settings are always skipped,
+    unless force is True. Returns the number of failures."""
+    queue = exporter.ExportQueue(
+        cropper.Cropper(config, interactive=False, overwrite=force),
+        workers,
+        manifest=manifest.Manifest(output_folder),
+        skip_unchanged=not force,
+    )
+    futures = {}
+    skipped = 0
+    missing = 0
+    for filename, box in boxes.items():
+        src_file = input_folder / filename
+        if not os.path.exists(src_file):
+            logger.error("Missing source image {}".format(src_file))
+            missing += 1
+            continue
+        future = queue.crop(src_file, output_folder / filename, box)
+        if future is None or future is exporter.UP_TO_DATE:
+            skipped += 1
+            continue
+        futures[future] = filename
+
+    logger.info("Exporting {} images, {} skipped".format(len(futures), skipped))
+    done = 0
+    for future in concurrent.futures.as_completed(futures):
+        done += 1
+        if future.exception() is None:
+            logger.info("[{}/{}] {}".format(done, len(futures), futures[future]))
+    queue.shutdown(wait=True)
+    pending, failed = queue.counts()
+    logger.info("Batch finished, {} failed".format(failed + missing))
+    return failed + missing
@@ -0,0 +1,341 @@
+#! /usr/bin/env python
+#
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Times cropall's hot paths on synthetic images and writes the results as JSON
+# so they can be compared between commits. E.g.:
+#
+#   python benchmarks/run.py --output before.json
+#   git checkout my-branch
+#   python benchmarks/run.py --output after.json --compare before.json
+
+import os
+import sys
+import json
+import time
+import math
+import bisect
+import shutil
+import pathlib
+import platform
+import argparse
+import tempfile
+import subprocess
+import statistics
+import configparser
+
+root = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root))
+
+import numpy as np
+import PIL
+from PIL import Image
+import box
+import gui
+import loader
+import pyramid
+import scanner
+import tiles
+import cropper
+import suggest
+
+parser = argparse.ArgumentParser(description="Times cropall hot paths")
+parser.add_argument(
+    "--megapixels",
+    type=float,
+    nargs="+",
+    default=[2, 12, 50],
+    help="Sizes of the synthetic images to test, e.g. 2 12 50 100",
+)
+parser.add_argument(
+    "--formats", nargs="+", default=["jpg", "png"], help="Synthetic image formats"
+)
+parser.add_argument(
+    "--repeat", type=int, default=5, help="Number of timed runs of each benchmark"
+)
+parser.add_argument(
+    "--scan-files", type=int, default=20000, help="Number of files for the scan test"
+)
+parser.add_argument("--output", type=pathlib.Path, help="Write results to this file")
+parser.add_argument(
+    "--compare", type=pathlib.Path, help="Print the change from a previous results file"
+)
+parser.add_argument(
+    "--workdir", type=pathlib.Path, help="Where to write images (default: temporary)"
+)
+
+
+def synthetic_image(megapixels):
+    "A 3:2 image with gradients and some noise, so it compresses like a photo"
+    width = int(math.sqrt(megapixels * 1e6 * 3 / 2))
+    height = int(width * 2 / 3)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    rng = np.random.default_rng(0)
+    noise = rng.normal(0, 12, (height, width)).astype(np.float32)
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1) + noise[..., None]
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), "RGB")
+
+
+def timed(function, repeat):
+    "Returns timing statistics of function() in milliseconds"
+    function()  # warm up
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - start) * 1000)
+    return {
+        "min_ms": min(times),
+        "median_ms": statistics.median(times),
+        "mean_ms": statistics.mean(times),
+        "runs": repeat,
+    }
+
+
+def config():
+    result = configparser.ConfigParser()
+    result.read(root / "cropall_default.ini")
+    result["gui"]["preview_cache"] = ""
+    result["cropper"]["confirm_overwrite"] = "False"
+    return result
+
+
+def bench_scan(workdir, count, repeat):
+    folder = workdir / "scan"
+    if not folder.exists():
+        folder.mkdir()
+        for i in range(count):
+            (folder / "img{}.{}".format(i, "jpg" if i % 4 else "txt")).touch()
+    extensions = config()["cropall"]["image_extensions"].split()
+    return timed(lambda: list(scanner.scan_images(folder, extensions)), repeat)
+
+
+def bench_selection(repeat):
+    """The work of a mouse scroll event in the scroll selection mode: stepping
+    the crop width with gui.crop_widths(), then gui.scroll_crop_box() and
+    scaling the box to the display as App.displayed_crop_box() does"""
+    image_size = box.Size2D(8192, 5464)
+    image_area = box.Size2D(1280, 1000)
+    mouse_position = box.Size2D(700, 400)
+    aspect = (3, 2)
+
+    def events():
+        width = 4000
+        for i in range(1000):
+            widths = gui.crop_widths(aspect[0], aspect[1], image_size[0], True)
+            width = widths[bisect.bisect_right(widths, width) % len(widths)]
+            image_box = box.Box2D.scale_down(image_size, image_area)
+            region = gui.scroll_crop_box(
+                image_box,
+                image_size,
+                mouse_position,
+                (width, width * aspect[1] / aspect[0]),
+            )
+            region.scaled(image_size, image_box.size).coords()
+
+    result = timed(events, repeat)
+    result["events"] = 1000
+    return result
+
+
+def bench_box_batch(repeat, results, count=10000):
+    "Scaling one crop box to many image sizes, as when propagating a crop"
+    rng = np.random.default_rng(0)
+    sizes = rng.integers(1000, 9000, (count, 2))
+    crop = box.Box2D((100, 200), (3000, 2000))
+    source = (6000, 4000)
+
+    def loop():
+        for size in sizes.tolist():
+            crop.scaled(source, size).clamped(size).coords()
+
+    def batch():
+        box.Box2DArray.repeat(crop, count).scaled(source, sizes).clamped(sizes).coords()
+
+    results["boxes/loop/{}".format(count)] = timed(loop, repeat)
+    results["boxes/batch/{}".format(count)] = timed(batch, repeat)
+
+
+def bench_image(path, repeat, results):
+    name = path.name
+    area = (1280, 1000)
+    preview_area = (1280, 1000)
+    size = Image.open(path).size
+    for fast, draft in ((True, True), (True, False), (False, False)):
+        label = "fast" if fast else "full"
+        label += "_draft" if draft else ""
+        options = (fast, True, draft, 0, None)
+        results["load_display/{}/{}".format(label, name)] = timed(
+            lambda: loader.load_image(name, path, area, options), repeat
+        )
+
+    loaded = loader.load_image(name, path, area, (True, True, True, 0, None))
+    crop_box = [
+        loaded.display.size[0] // 4,
+        loaded.display.size[1] // 4,
+        loaded.display.size[0] * 3 // 4,
+        loaded.display.size[1] * 3 // 4,
+    ]
+    results["update_preview/fast/{}".format(name)] = timed(
+        lambda: loader.make_preview_image(loaded.display, crop_box, preview_area),
+        repeat,
+    )
+    for engine in suggest.ENGINES:
+        results["suggest/{}/{}".format(engine, name)] = timed(
+            lambda: suggest.best_window(
+                suggest.energy_map(loaded.display, engine), (3, 2)
+            ),
+            repeat,
+        )
+    full = Image.open(path)
+    full.load()
+    full_box = [size[0] // 4, size[1] // 4, size[0] * 3 // 4, size[1] * 3 // 4]
+    results["update_preview/full/{}".format(name)] = timed(
+        lambda: loader.make_preview_image(full, full_box, preview_area), repeat
+    )
+    levels = pyramid.ImagePyramid(full)
+    preview_size = box.Box2D.contain(
+        (full_box[2] - full_box[0], full_box[3] - full_box[1]), preview_area
+    ).size
+    results["update_preview/pyramid/{}".format(name)] = timed(
+        lambda: loader.make_preview_image(
+            *levels.select(full_box, preview_size), preview_area
+        ),
+        repeat,
+    )
+
+    reader = tiles.open_reader(path, 1e-6)
+    if reader is not None:
+        # Times reading as if the image was above tiled_megapixels
+        with reader:
+            results["load_display/tiled/{}".format(name)] = timed(
+                lambda: loader.load_tiled(
+                    name, reader, area, (False, True, False, 0, None)
+                ),
+                repeat,
+            )
+            results["crop/tiled/{}".format(name)] = timed(
+                lambda: tiles.crop(reader, full_box, preview_size), repeat
+            )
+
+    export = cropper.Cropper(config())
+    dst = path.parent / "out" / name
+    backends = ["pillow"]
+    try:
+        import wand.image
+
+        backends.append("wand")
+    except ImportError:
+        pass
+    for backend in backends:
+        export.config["cropper"]["backend"] = backend
+        results["crop/{}/{}".format(backend, name)] = timed(
+            lambda: export.crop(path, dst, full_box), repeat
+        )
+        results["resize/{}/{}".format(backend, name)] = timed(
+            lambda: export.resize(path, dst), repeat
+        )
+    if "wand" in backends:
+        export.config["cropper"]["backend"] = "wand"
+        export.config["cropper"]["encoder"] = "pillow"
+        results["crop/wand_pillow_encoder/{}".format(name)] = timed(
+            lambda: export.crop(path, dst, full_box), repeat
+        )
+        export.config["cropper"]["encoder"] = "backend"
+    results["copy/{}".format(name)] = timed(lambda: export.copy(path, dst), repeat)
+
+
+def metadata():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pillow": PIL.__version__,
+        "numpy": np.__version__,
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def compare(results, baseline):
+    print(
+        "{:<50} {:>12} {:>12} {:>8}".format(
+            "benchmark", "before ms", "after ms", "change"
+        ),
+        file=sys.stderr,
+    )
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["median_ms"]
+        after = result["median_ms"]
+        change = (after - before) / before * 100 if before else 0
+        print(
+            "{:<50} {:>12.2f} {:>12.2f} {:>+7.0f}%".format(name, before, after, change),
+            file=sys.stderr,
+        )
+
+
+def main():
+    args = parser.parse_args()
+    workdir = args.workdir or pathlib.Path(tempfile.mkdtemp(prefix="cropall_bench_"))
+    workdir.mkdir(parents=True, exist_ok=True)
+    results = {}
+    try:
+        print("Scanning {} files".format(args.scan_files), file=sys.stderr)
+        results["scan/{}".format(args.scan_files)] = bench_scan(
+            workdir, args.scan_files, args.repeat
+        )
+        print("Selection geometry", file=sys.stderr)
+        results["selection/1000_events"] = bench_selection(args.repeat)
+        bench_box_batch(args.repeat, results)
+        for megapixels in args.megapixels:
+            image = None
+            for fmt in args.formats:
+                path = workdir / "{}mp.{}".format(megapixels, fmt)
+                if not path.exists():
+                    image = image or synthetic_image(megapixels)
+                    image.save(path)
+                print("Image {}".format(path.name), file=sys.stderr)
+                (workdir / "out").mkdir(exist_ok=True)
+                bench_image(path, args.repeat, results)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    report = {"meta": metadata(), "results": results}
+    if args.output:
+        with open(args.output, "w") as filehandle:
+            json.dump(report, filehandle, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as filehandle:
+            compare(results, json.load(filehandle)["results"])
+
+
+if __name__ == "__main__":
+    main()
@@ -15,81 +15,276 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import numpy as np
+from math import ceil
 
 
-class Size2D(np.ndarray):
-    def __new__(cls, width, height):
-        obj = np.asarray([width, height], dtype="int").view(cls)
-        return obj
+def _pair(value):
+    "Returns value as an (x, y) tuple, broadcasting scalars"
+    if type(value) is Size2D:
+        return value.x, value.y
+    if isinstance(value, (tuple, list)) or hasattr(value, "__len__"):
+        return value[0], value[1]
+    return value, value
+
+
+def _sign(x):
+    return (x > 0) - (x < 0)
+
+
+class Size2D:
+    """A 2D size or position. Plain python scalars are much faster than small
+    numpy arrays for the handful of operations done per mouse event. The
+    constructor truncates to integers, like the int arrays this used to be,
+    but arithmetic results keep their fractions."""
+
+    __slots__ = ("x", "y")
+
+    def __init__(self, width, height):
+        self.x = int(width)
+        self.y = int(height)
 
     @staticmethod
     def center(source_size, destination_size):
-        remaining_size = destination_size - source_size
-        return remaining_size / 2
+        sx, sy = _pair(source_size)
+        dx, dy = _pair(destination_size)
+        return _vector((dx - sx) / 2, (dy - sy) / 2)
+
+    def __getitem__(self, index):
+        if index == 0 or index == -2:
+            return self.x
+        if index == 1 or index == -1:
+            return self.y
+        raise IndexError("Size2D index out of range")
+
+    def __setitem__(self, index, value):
+        if index == 0 or index == -2:
+            self.x = value
+        elif index == 1 or index == -1:
+            self.y = value
+        else:
+            raise IndexError("Size2D index out of range")
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        yield self.x
+        yield self.y
+
+    def __eq__(self, other):
+        try:
+            ox, oy = _pair(other)
+        except (TypeError, IndexError):
+            return NotImplemented
+        return self.x == ox and self.y == oy
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Size2D({}, {})".format(self.x, self.y)
+
+    def __add__(self, other):
+        if type(other) is Size2D:
+            return _vector(self.x + other.x, self.y + other.y)
+        ox, oy = _pair(other)
+        return _vector(self.x + ox, self.y + oy)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if type(other) is Size2D:
+            return _vector(self.x - other.x, self.y - other.y)
+        ox, oy = _pair(other)
+        return _vector(self.x - ox, self.y - oy)
+
+    def __rsub__(self, other):
+        ox, oy = _pair(other)
+        return _vector(ox - self.x, oy - self.y)
+
+    def __mul__(self, other):
+        if type(other) is Size2D:
+            return _vector(self.x * other.x, self.y * other.y)
+        ox, oy = _pair(other)
+        return _vector(self.x * ox, self.y * oy)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if type(other) is Size2D:
+            return _vector(self.x / other.x, self.y / other.y)
+        ox, oy = _pair(other)
+        return _vector(self.x / ox, self.y / oy)
+
+    def __rtruediv__(self, other):
+        ox, oy = _pair(other)
+        return _vector(ox / self.x, oy / self.y)
+
+    def __floordiv__(self, other):
+        if type(other) is Size2D:
+            return _vector(self.x // other.x, self.y // other.y)
+        ox, oy = _pair(other)
+        return _vector(self.x // ox, self.y // oy)
+
+    def __neg__(self):
+        return _vector(-self.x, -self.y)
+
+    def astype(self, dtype):
+        return _vector(dtype(self.x), dtype(self.y))
+
+    def copy(self):
+        return _vector(self.x, self.y)
+
+    def tolist(self):
+        return [self.x, self.y]
+
+
+def _vector(x, y):
+    "Creates a Size2D without converting to integers"
+    obj = _new(Size2D)
+    obj.x = x
+    obj.y = y
+    return obj
+
+
+_new = object.__new__
+
+
+# The inverse of each EXIF orientation that is not its own inverse
+_INVERSE_ORIENTATION = {6: 8, 8: 6}
+
+
+def oriented_size(size, orientation):
+    "Returns the size of an image once shown upright for its EXIF orientation"
+    width, height = _pair(size)
+    if orientation in (5, 6, 7, 8):
+        return Size2D(height, width)
+    return Size2D(width, height)
+
+
+def _orient_point(x, y, width, height, orientation):
+    if orientation == 2:
+        return width - x, y
+    if orientation == 3:
+        return width - x, height - y
+    if orientation == 4:
+        return x, height - y
+    if orientation == 5:
+        return y, x
+    if orientation == 6:
+        return height - y, x
+    if orientation == 7:
+        return height - y, width - x
+    if orientation == 8:
+        return y, width - x
+    return x, y
+
+
+def orient_coords(coords, size, orientation):
+    """Maps [left, upper, right, lower] in a stored image of size to the same
+    region of the image shown upright for its EXIF orientation"""
+    width, height = _pair(size)
+    x0, y0 = _orient_point(coords[0], coords[1], width, height, orientation)
+    x1, y1 = _orient_point(coords[2], coords[3], width, height, orientation)
+    return [min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)]
+
+
+def unorient_coords(coords, size, orientation):
+    """Maps [left, upper, right, lower] in the upright image back to the stored
+    image of size, the inverse of orient_coords()"""
+    return orient_coords(
+        coords,
+        oriented_size(size, orientation),
+        _INVERSE_ORIENTATION.get(orientation, orientation),
+    )
 
 
 class Box2D:
     "A rectangle with an offset and size"
 
+    __slots__ = ("offset", "size")
+
     def __init__(self, offset, size):
-        self.offset = offset.astype(int)
-        self.size = np.ceil(size).astype(int)
+        ox, oy = _pair(offset)
+        sx, sy = _pair(size)
+        self.offset = _vector(int(ox), int(oy))
+        self.size = _vector(ceil(sx), ceil(sy))
+
+    def __repr__(self):
+        return "Box2D({}, {})".format(self.offset, self.size)
 
     def copy(self):
         return Box2D(self.offset, self.size)
 
     def clamped(self, size):
         "Returns a box with the same size moved such that it's within size"
-        delta_over = np.maximum(self.offset + self.size, size) - size
-        delta_under = np.minimum(self.offset, [0, 0])
-        return Box2D(self.offset - delta_over - delta_under, self.size)
+        wx, wy = _pair(size)
+        over_x = max(self.offset.x + self.size.x, wx) - wx
+        over_y = max(self.offset.y + self.size.y, wy) - wy
+        under_x = min(self.offset.x, 0)
+        under_y = min(self.offset.y, 0)
+        return Box2D(
+            (self.offset.x - over_x - under_x, self.offset.y - over_y - under_y),
+            self.size,
+        )
 
     def min_max(self):
+        x0, y0 = self.offset.x, self.offset.y
+        x1, y1 = x0 + self.size.x, y0 + self.size.y
         return (
-            np.minimum(self.offset, self.offset + self.size),
-            np.maximum(self.offset, self.offset + self.size),
+            _vector(min(x0, x1), min(y0, y1)),
+            _vector(max(x0, x1), max(y0, y1)),
         )
 
     @staticmethod
     def from_min_max(coord_min, coord_max):
-        return Box2D(coord_min, coord_max - coord_min)
+        return Box2D(coord_min, _vector(*_pair(coord_max)) - coord_min)
 
     def positive_size(self):
         return Box2D.from_min_max(*self.min_max())
 
     def coords(self):
         "Returns [left, upper, right, lower] coordinates that can be passed to Image.crop()"
-        return np.concatenate((self.offset, self.offset + self.size))
+        return [
+            self.offset.x,
+            self.offset.y,
+            self.offset.x + self.size.x,
+            self.offset.y + self.size.y,
+        ]
 
     def scaled(self, source_size, destination_size):
         "Returns the box transformed from coordinates of source_size to destination_size, e.g. to find the same relative box in different units"
+        sx, sy = _pair(source_size)
+        dx, dy = _pair(destination_size)
         return Box2D(
-            (self.offset * destination_size) / source_size,
-            (self.size * destination_size) / source_size,
+            ((self.offset.x * dx) / sx, (self.offset.y * dy) / sy),
+            ((self.size.x * dx) / sx, (self.size.y * dy) / sy),
         )
 
     def __sub__(self, other):
         "Subtracts the other box's offset"
         offset = other.offset if isinstance(other, Box2D) else other
-        return Box2D(
-            self.offset - offset,
-            self.size,
-        )
+        return Box2D(self.offset - offset, self.size)
 
     def __add__(self, other):
         "Adds the other box's offset"
         offset = other.offset if isinstance(other, Box2D) else other
-        return Box2D(
-            self.offset + offset,
-            self.size,
-        )
+        return Box2D(self.offset + offset, self.size)
 
     @staticmethod
     def fill(source_size, destination_size):
         "Like CSS - the image is resized to fill the given dimension. If necessary, the image will be stretched or squished to fit"
         return Box2D(Size2D(0, 0), destination_size)
 
+    @staticmethod
+    def _fit(source_size, destination_size, scale, center):
+        sx, sy = _pair(source_size)
+        dx, dy = _pair(destination_size)
+        box_size = _vector(sx * _sign(dx) * scale, sy * _sign(dy) * scale)
+        box_offset = (
+            Size2D.center(box_size, destination_size) if center else Size2D(0, 0)
+        )
+        return Box2D(box_offset, box_size)
+
     @staticmethod
     def contain(source_size, destination_size, center=True):
         assert source_size[0] > 0 and source_size[1] > 0
@@ -98,11 +293,7 @@ class Box2D:
             abs(destination_size[0] / source_size[0]),
             abs(destination_size[1] / source_size[1]),
         )
-        box_size = np.array(source_size) * np.sign(destination_size) * scale
-        box_offset = (
-            Size2D.center(box_size, destination_size) if center else Size2D(0, 0)
-        )
-        return Box2D(box_offset, box_size)
+        return Box2D._fit(source_size, destination_size, scale, center)
 
     @staticmethod
     def cover(source_size, destination_size, center=True):
@@ -112,11 +303,7 @@ class Box2D:
             abs(destination_size[0] / source_size[0]),
             abs(destination_size[1] / source_size[1]),
         )
-        box_size = np.array(source_size) * np.sign(destination_size) * scale
-        box_offset = (
-            Size2D.center(box_size, destination_size) if center else Size2D(0, 0)
-        )
-        return Box2D(box_offset, box_size)
+        return Box2D._fit(source_size, destination_size, scale, center)
 
     @staticmethod
     def scale_down(source_size, destination_size, center=True):
@@ -127,8 +314,80 @@ class Box2D:
             abs(destination_size[1] / source_size[1]),
         )
         scale = min(1, scale)
-        box_size = np.array(source_size) * np.sign(destination_size) * scale
-        box_offset = (
-            Size2D.center(box_size, destination_size) if center else Size2D(0, 0)
+        return Box2D._fit(source_size, destination_size, scale, center)
+
+
+class Box2DArray:
+    """Many boxes at once as (N, 2) numpy arrays of offsets and sizes, for
+    computing crops for whole runs of images in the batch and export paths.
+    Rounding matches Box2D. numpy is imported by the methods so that box, used
+    all over the GUI, does not slow down startup."""
+
+    def __init__(self, offsets, sizes):
+        import numpy as np
+
+        self.offsets = np.trunc(np.asarray(offsets, dtype=float)).astype(int)
+        self.sizes = np.ceil(np.asarray(sizes, dtype=float)).astype(int)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        return Box2D(self.offsets[index].tolist(), self.sizes[index].tolist())
+
+    @staticmethod
+    def from_coords(coords):
+        "Creates boxes from an (N, 4) array of [left, upper, right, lower]"
+        import numpy as np
+
+        coords = np.asarray(coords)
+        return Box2DArray(coords[:, :2], coords[:, 2:] - coords[:, :2])
+
+    @staticmethod
+    def repeat(box, count):
+        import numpy as np
+
+        return Box2DArray(
+            np.tile(box.offset.tolist(), (count, 1)),
+            np.tile(box.size.tolist(), (count, 1)),
         )
-        return Box2D(box_offset, box_size)
+
+    def coords(self):
+        "Returns an (N, 4) array of [left, upper, right, lower] coordinates"
+        import numpy as np
+
+        return np.concatenate((self.offsets, self.offsets + self.sizes), axis=1)
+
+    def scaled(self, source_sizes, destination_sizes):
+        "Like Box2D.scaled(), with a source and destination size per box, or one for all"
+        import numpy as np
+
+        source_sizes = np.asarray(source_sizes, dtype=float)
+        destination_sizes = np.asarray(destination_sizes, dtype=float)
+        return Box2DArray(
+            (self.offsets * destination_sizes) / source_sizes,
+            (self.sizes * destination_sizes) / source_sizes,
+        )
+
+    def clamped(self, sizes):
+        "Like Box2D.clamped(), with a size per box or one for all"
+        import numpy as np
+
+        sizes = np.asarray(sizes)
+        delta_over = np.maximum(self.offsets + self.sizes, sizes) - sizes
+        delta_under = np.minimum(self.offsets, 0)
+        return Box2DArray(self.offsets - delta_over - delta_under, self.sizes)
+
+    @staticmethod
+    def scale_down(source_sizes, destination_size, center=True):
+        "Like Box2D.scale_down() for an (N, 2) array of source sizes"
+        import numpy as np
+
+        source_sizes = np.asarray(source_sizes, dtype=float)
+        destination_size = np.asarray(destination_size, dtype=float)
+        scale = np.minimum(
+            np.abs(destination_size / source_sizes).min(axis=1, keepdims=True), 1
+        )
+        sizes = source_sizes * np.sign(destination_size) * scale
+        offsets = (destination_size - sizes) / 2 if center else np.zeros_like(sizes)
+        return Box2DArray(offsets, sizes)
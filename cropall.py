@@ -17,15 +17,21 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# First, so that --startup-timing counts from here
+import metrics
 import os
 import sys
+import logging
 import error_handler
 import argparse
 import configparser
 import pathlib
 import shutil
+import multiprocessing
+import scanner
 
 logger = error_handler.activate("cropall")
+metrics.mark("imports")
 
 default_config_file = pathlib.Path("cropall_default.ini")
 config_file = pathlib.Path("cropall.ini")
@@ -51,6 +57,7 @@ config = configparser.ConfigParser()
 config.read(default_config_file)
 if os.path.exists(config_file):
     config.read(config_file)
+metrics.mark("config")
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -59,27 +66,104 @@ parser.add_argument(
     nargs="?",
     help="Directories for source photos",
 )
+parser.add_argument(
+    "--recursive",
+    action=argparse.BooleanOptionalAction,
+    default=None,
+    help="Include images in subdirectories, mirroring them in the output folder. Saved in the config until --no-recursive is given",
+)
+parser.add_argument(
+    "--batch",
+    type=pathlib.Path,
+    metavar="MANIFEST",
+    help="Crop the images listed in a JSON file mapping filenames to [left, upper, right, lower] boxes, without the GUI",
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=None,
+    help="Number of export processes in batch mode (default: export_processes from the config)",
+)
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="In batch mode, re-export images even if they exist or the manifest shows they are up to date",
+)
+
+
+# Where --profile writes its report if no file is given
+PROFILE_REPORT = pathlib.Path("cropall_profile.json")
+
+parser.add_argument(
+    "--profile",
+    nargs="?",
+    type=pathlib.Path,
+    const=PROFILE_REPORT,
+    metavar="REPORT",
+    help="Time the main steps and write a report of counts, p50, p95 and max times when cropall exits (default: cropall_profile.json)",
+)
+parser.add_argument(
+    "--cprofile",
+    type=pathlib.Path,
+    metavar="FILE",
+    help="Also run cProfile and write its stats to FILE for pstats or snakeviz. Implies --profile",
+)
+parser.add_argument(
+    "--trace",
+    type=pathlib.Path,
+    metavar="FILE",
+    help="Also write the timed steps as Chrome trace events, for chrome://tracing or ui.perfetto.dev. Implies --profile",
+)
+parser.add_argument(
+    "--startup-timing",
+    action="store_true",
+    help="Report how long each step took until the first image is shown and the window responds",
+)
+
+
+def start_profile(args):
+    if args.profile is None:
+        return None
+    metrics.registry.enable(trace=args.trace is not None)
+    if args.cprofile is None:
+        return None
+    import cProfile
 
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
 
-def getImages(config, dir):
-    logger.info("Scanning {}".format(dir))
-    extensions = config["image_extensions"].split()
-    images = []
-    for filename in os.listdir(dir):
-        basename, ext = os.path.splitext(filename)
-        if ext.lower() in extensions:
-            logger.info("  Found {}".format(filename))
-            images += [filename]
-    logger.info("Found {} images".format(len(images)))
-    return images
+
+def finish_profile(args, profiler):
+    if args.profile is None:
+        return
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+        logger.info("Wrote cProfile stats to {}".format(args.cprofile))
+    if args.trace is not None:
+        metrics.registry.write_trace(args.trace)
+        logger.info("Wrote trace to {}".format(args.trace))
+    metrics.registry.write_report(args.profile)
+    logger.info(
+        "Profile written to {}\n{}".format(args.profile, metrics.registry.report())
+    )
 
 
 if __name__ == "__main__":
+    # Exports run in worker processes, which needs this in pyinstaller builds
+    multiprocessing.freeze_support()
+
     cropall_config = config["cropall"]
     cropall_config["first_run"] = "False"
     args = parser.parse_args()
+    if args.profile is None and (args.cprofile or args.trace):
+        args.profile = PROFILE_REPORT
+    profiler = start_profile(args)
     if args.input_folder:
         input_folder = str(args.input_folder)
+    elif args.batch:
+        raise SystemExit("An input folder is required in batch mode. Exiting.")
     else:
         # Ask for the input directory
         import tkinter.filedialog
@@ -90,12 +174,38 @@ if __name__ == "__main__":
     if not len(input_folder):
         raise ValueError("No directory selected. Exiting.")
     input_folder = pathlib.Path(os.path.normpath(input_folder))
-    images = getImages(cropall_config, input_folder)
+    output_folder = input_folder / pathlib.Path(cropall_config["output_folder"])
+
+    if args.batch:
+        # Headless mode must not import tkinter or the gui
+        import batch
+
+        logger.setLevel(logging.INFO)
+        boxes = batch.load_manifest(args.batch)
+        os.makedirs(output_folder, exist_ok=True)
+        failed = batch.run(
+            config, input_folder, output_folder, boxes, args.jobs, args.force
+        )
+        finish_profile(args, profiler)
+        sys.exit(1 if failed else 0)
+
+    if args.recursive is not None:
+        cropall_config["recursive"] = str(args.recursive)
+
+    # Scan in the background and show the first images as soon as they are found
+    logger.info("Scanning {}".format(input_folder))
+    image_scanner = scanner.ImageScanner(
+        input_folder,
+        cropall_config["image_extensions"].split(),
+        cropall_config.getboolean("recursive"),
+        exclude=[output_folder],
+    ).start()
+    images = image_scanner.wait_for_first()
+    metrics.mark("first images found")
     if not len(images):
         raise SystemExit("No images found in '{}'. Exiting.".format(input_folder))
     cropall_config["input_folder"] = str(input_folder)
 
-    output_folder = input_folder / pathlib.Path(cropall_config["output_folder"])
     if not os.path.exists(output_folder):
         logger.info("Creating output directory, '{}'".format(output_folder))
         os.makedirs(output_folder)
@@ -106,8 +216,16 @@ if __name__ == "__main__":
 
     import gui
 
-    app = gui.App(config, cropper, input_folder, images, output_folder)
+    metrics.mark("gui imported")
+    app = gui.App(config, cropper, input_folder, images, output_folder, image_scanner)
+    if args.startup_timing:
+        # Runs once the first image is drawn and the window handles events
+        app.after_idle(
+            lambda: logger.info("Startup timing\n{}".format(metrics.startup.report()))
+        )
     app.mainloop()
+    app.exporter.shutdown(wait=True)
+    finish_profile(args, profiler)
 
     with open(config_file, "w") as filehandle:
         config.write(filehandle)
@@ -86,7 +86,8 @@ exe = EXE(
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
+    # UPX compressed binaries are decompressed every time cropall starts
+    upx=False,
     console=sys.platform != "win32",
     disable_windowed_traceback=False,
     argv_emulation=False,
@@ -99,7 +100,7 @@ coll = COLLECT(
     a.binaries,
     a.datas,
     strip=False,
-    upx=True,
+    upx=False,
     upx_exclude=[],
     name='cropall',
 )
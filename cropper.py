@@ -17,61 +17,650 @@
 
 import os
 import shutil
+import math
 import logging
-import wand.image
-from tkinter import messagebox
+import functools
+import subprocess
+import exif
+import metrics
+from PIL import Image
+from box import unorient_coords
 
 logger = logging.getLogger("cropall")
 
+# Options of the [encoder.NAME] config sections, the Pillow format they apply to
+# and their types. They are passed to Image.save() as is.
+ENCODERS = {
+    "jpeg": (
+        "JPEG",
+        {"quality": int, "subsampling": str, "progressive": bool, "optimize": bool},
+    ),
+    "png": ("PNG", {"compress_level": int, "optimize": bool}),
+    "webp": ("WEBP", {"quality": int, "lossless": bool, "method": int}),
+    "avif": ("AVIF", {"quality": int, "speed": int}),
+}
+
+# ImageMagick's names for JPEG chroma subsampling
+SAMPLING_FACTORS = {"4:4:4": "1x1", "4:2:2": "2x1", "4:2:0": "2x2"}
+
+
+def make_parent_dirs(dst_file):
+    "Creates the output subdirectory for images from recursive input folders"
+    os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+
+
+def fit_size(size, resize):
+    """Returns size shrunk to fit in resize keeping its aspect, like
+    ImageMagick's WxH> geometry. A resize width or height of 0 is unlimited."""
+    if not resize:
+        return tuple(size)
+    scale = min(
+        1,
+        resize[0] / size[0] if resize[0] else 1,
+        resize[1] / size[1] if resize[1] else 1,
+    )
+    return (max(1, round(size[0] * scale)), max(1, round(size[1] * scale)))
+
+
+def with_format(dst_file, fmt):
+    "Returns dst_file with the extension fmt, or unchanged if fmt is empty"
+    if not fmt:
+        return dst_file
+    return os.path.splitext(dst_file)[0] + "." + fmt
+
+
+def output_file(dst_file, settings):
+    "Returns where dst_file is written in the settings' output_format"
+    return with_format(dst_file, settings.get("format"))
+
+
+def rendition_file(dst_file, rendition, settings):
+    """Returns where a rendition of dst_file is written: in the rendition's
+    subfolder of dst_file's folder, with its format's extension"""
+    folder, name = os.path.split(dst_file)
+    name = with_format(name, rendition["format"] or settings.get("format"))
+    return os.path.join(folder, rendition["subfolder"], name)
+
+
+def output_files(dst_file, settings):
+    "Returns the files an export with settings writes for dst_file"
+    if not settings.get("renditions"):
+        return [output_file(dst_file, settings)]
+    return [
+        rendition_file(dst_file, rendition, settings)
+        for rendition in settings["renditions"]
+    ]
+
+
+def job_settings(dst_file, settings):
+    """Returns settings with only the [encoder.NAME] options of the formats
+    written for dst_file, so that the manifest doesn't see an export as stale
+    when the options of a format it doesn't use change"""
+    if not settings.get("encoders"):
+        return settings
+    formats = set(image_format(path) for path in output_files(dst_file, settings))
+    result = dict(settings)
+    result["encoders"] = {
+        fmt: options for fmt, options in settings["encoders"].items() if fmt in formats
+    }
+    return result
+
+
+def image_format(dst_file):
+    "Returns the Pillow format name for dst_file's extension"
+    ext = os.path.splitext(dst_file)[1].lower()
+    if ext == ".avif":
+        return "AVIF"
+    return Image.registered_extensions().get(ext)
+
+
+def encoder_options(fmt, settings, quality=None):
+    "Returns the [encoder.NAME] options for writing fmt"
+    options = dict(settings.get("encoders", {}).get(fmt, {})) if settings else {}
+    if quality:
+        options["quality"] = quality
+    return options
+
+
+def wand_save(img, dst_file, settings, quality=None):
+    """Writes a Wand image with the encoder options in settings, or converts it
+    and writes it with Pillow if the encoder setting is 'pillow'"""
+    if settings.get("encoder") == "pillow":
+        img.depth = 8
+        mode = "RGBA" if img.alpha_channel else "RGB"
+        image = Image.frombytes(mode, img.size, img.make_blob(mode))
+        pillow_save(image, dst_file, settings, quality)
+        return
+    fmt = image_format(dst_file)
+    options = encoder_options(fmt, settings, quality)
+    if options.get("quality"):
+        img.compression_quality = options["quality"]
+    if fmt == "JPEG":
+        if options.get("subsampling") in SAMPLING_FACTORS:
+            img.options["jpeg:sampling-factor"] = SAMPLING_FACTORS[
+                options["subsampling"]
+            ]
+        if options.get("progressive"):
+            img.interlace_scheme = "plane"
+        if options.get("optimize"):
+            img.options["jpeg:optimize-coding"] = "true"
+    elif fmt == "PNG":
+        if "compress_level" in options:
+            img.options["png:compression-level"] = str(options["compress_level"])
+    elif fmt == "WEBP":
+        if options.get("lossless"):
+            img.options["webp:lossless"] = "true"
+        if "method" in options:
+            img.options["webp:method"] = str(options["method"])
+    elif fmt == "AVIF":
+        if "speed" in options:
+            img.options["heic:speed"] = str(options["speed"])
+    img.save(filename=dst_file)
+
+
+def wand_crop_file(src_file, dst_file, box, settings):
+    import wand.image
+
+    resize = settings["resize"]
+    with wand.image.Image(filename=src_file) as img:
+        if box is not None:
+            crop = "{}x{}+{}+{}".format(
+                box[2] - box[0], box[3] - box[1], box[0], box[1]
+            )
+            img.transform(crop=crop)
+        if resize:
+            img.transform(resize="{}x{}>".format(*resize))
+        # Turned upright only once cropped and shrunk
+        img.auto_orient()
+        wand_save(img, dst_file, settings)
+
+
+def wand_crop_renditions(src_file, dst_file, box, settings, renditions, sizes):
+    "Decodes and crops once, then shrinks in place for each successively smaller rendition"
+    import wand.image
+
+    with wand.image.Image(filename=src_file) as img:
+        if box is not None:
+            crop = "{}x{}+{}+{}".format(
+                box[2] - box[0], box[3] - box[1], box[0], box[1]
+            )
+            img.transform(crop=crop)
+        for rendition, size in zip(renditions, sizes):
+            if (img.width, img.height) != size:
+                img.resize(*size)
+            path = rendition_file(dst_file, rendition, settings)
+            make_parent_dirs(path)
+            with img.clone() as upright:
+                upright.auto_orient()
+                wand_save(upright, path, settings, rendition["quality"])
+
+
+def pillow_save(image, dst_file, settings=None, quality=None):
+    "Writes image with the [encoder.NAME] options in settings for its format"
+    fmt = image_format(dst_file)
+    if fmt == "AVIF" and fmt not in Image.SAVE:
+        try:
+            # Imported only to register AVIF with Pillow versions without it
+            import pillow_avif  # noqa: F401
+        except ImportError:
+            raise ValueError(
+                "Pillow can't write AVIF, install pillow-avif-plugin or use the wand backend"
+            )
+    options = encoder_options(fmt, settings, quality)
+    if fmt == "JPEG":
+        if image.mode not in ("RGB", "L", "CMYK"):
+            image = image.convert("RGB")
+        # Close to ImageMagick's default rather than Pillow's 75
+        options.setdefault("quality", 92)
+    elif fmt in ("WEBP", "AVIF") and image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    image.save(dst_file, fmt, **options)
+
+
+def pillow_crop_image(image, box, resize):
+    "Crops and shrinks an already decoded PIL image"
+    if box is None:
+        box = (0, 0) + image.size
+    size = fit_size((box[2] - box[0], box[3] - box[1]), resize)
+    if size == (box[2] - box[0], box[3] - box[1]):
+        return image.crop(box)
+    return image.resize(size, Image.LANCZOS, box=box)
+
+
+def pillow_crop_file(src_file, dst_file, box, settings, orientation=1):
+    pillow_save(
+        exif.upright(
+            pillow_crop_source(src_file, box, settings["resize"]), orientation
+        ),
+        dst_file,
+        settings,
+    )
+
+
+def pillow_crop_source(src_file, box, resize):
+    "Returns the box region of src_file shrunk to fit resize, decoding as little as possible"
+    image = Image.open(src_file)
+    source_size = image.size
+    if box is None:
+        box = (0, 0) + source_size
+    crop_size = (box[2] - box[0], box[3] - box[1])
+    size = fit_size(crop_size, resize)
+    if size != crop_size:
+        # The output is smaller, so let JPEGs decode at a reduced scale. The
+        # image is decoded just once either way.
+        image.draft(
+            image.mode,
+            (
+                math.ceil(source_size[0] * size[0] / crop_size[0]),
+                math.ceil(source_size[1] * size[1] / crop_size[1]),
+            ),
+        )
+    if image.size == source_size:
+        result = pillow_crop_image(image, box, resize)
+    else:
+        scale_x = image.size[0] / source_size[0]
+        scale_y = image.size[1] / source_size[1]
+        region = (
+            box[0] * scale_x,
+            box[1] * scale_y,
+            box[2] * scale_x,
+            box[3] * scale_y,
+        )
+        result = image.resize(size, Image.LANCZOS, box=region)
+    return result
+
+
+def tiled_crop_file(reader, dst_file, box, settings, orientation=1):
+    "Crops a huge image from a tiles.TiledReader, reading only the tiles under the box"
+    pillow_save(
+        exif.upright(tiled_crop_source(reader, box, settings["resize"]), orientation),
+        dst_file,
+        settings,
+    )
+
+
+def tiled_crop_source(reader, box, resize):
+    if box is None:
+        box = (0, 0) + tuple(reader.size)
+    import tiles
+
+    size = fit_size((box[2] - box[0], box[3] - box[1]), resize)
+    return tiles.crop(reader, box, size)
+
+
+def crop_renditions(
+    src_file, dst_file, box, settings, image=None, reader=None, orientation=1
+):
+    """Writes each of settings["renditions"] for the box region of src_file.
+    The source is decoded and cropped once, to the biggest rendition, and each
+    smaller one is shrunk from the one before it. Each is turned upright for
+    the EXIF orientation as it is written."""
+    if box is None:
+        with Image.open(src_file) as source:
+            box = (0, 0) + source.size
+    crop_size = (box[2] - box[0], box[3] - box[1])
+    renditions = sorted(
+        settings["renditions"],
+        key=lambda rendition: fit_size(crop_size, rendition["size"]),
+        reverse=True,
+    )
+    sizes = [fit_size(crop_size, rendition["size"]) for rendition in renditions]
+    if image is None and reader is None and settings["backend"] != "pillow":
+        wand_crop_renditions(src_file, dst_file, box, settings, renditions, sizes)
+        return
+    if image is not None:
+        result = pillow_crop_image(image, box, sizes[0])
+    elif reader is not None:
+        result = tiled_crop_source(reader, box, sizes[0])
+    else:
+        result = pillow_crop_source(src_file, box, sizes[0])
+    for rendition, size in zip(renditions, sizes):
+        if result.size != size:
+            result = result.resize(size, Image.LANCZOS)
+        path = rendition_file(dst_file, rendition, settings)
+        make_parent_dirs(path)
+        pillow_save(
+            exif.upright(result, orientation), path, settings, rendition["quality"]
+        )
+
+
+def jpeg_mcu_size(image):
+    "Returns the size of a JPEG's minimum coded unit, which lossless crops align to"
+    return (
+        8 * max(layer[1] for layer in image.layer),
+        8 * max(layer[2] for layer in image.layer),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def find_jpegtran():
+    jpegtran = shutil.which("jpegtran")
+    if jpegtran is None:
+        logger.warning("jpegtran not found, lossless JPEG crops are disabled")
+    return jpegtran
+
+
+def lossless_crop_file(src_file, dst_file, box, resize):
+    """Crops a JPEG in the DCT domain with jpegtran, without decoding or
+    re-encoding it. Returns False, doing nothing, if that is not possible:
+    the source is not a JPEG, the output would be resized or is not a JPEG, or
+    jpegtran is not installed.
+
+    The box's top left corner is moved up and left onto the MCU grid, so the
+    output may be up to 15 pixels bigger than the box. If that snapped size no
+    longer fits within resize, False is returned too."""
+    jpegtran = find_jpegtran()
+    if jpegtran is None:
+        return False
+    if image_format(dst_file) != "JPEG":
+        return False
+    with Image.open(src_file) as image:
+        if image.format != "JPEG":
+            return False
+        if box is None:
+            box = (0, 0) + image.size
+        mcu = jpeg_mcu_size(image)
+    left = box[0] - box[0] % mcu[0]
+    upper = box[1] - box[1] % mcu[1]
+    # The snapped output must fit the resize bounds too, or it is re-encoded
+    size = (box[2] - left, box[3] - upper)
+    if fit_size(size, resize) != size:
+        return False
+    crop = "{}x{}+{}+{}".format(size[0], size[1], left, upper)
+    subprocess.run(
+        [
+            jpegtran,
+            "-copy",
+            "all",
+            "-crop",
+            crop,
+            "-outfile",
+            str(dst_file),
+            str(src_file),
+        ],
+        check=True,
+        capture_output=True,
+    )
+    return True
+
+
+def lossless_crop(src_file, dst_file, box, resize):
+    """Like lossless_crop_file(), but returns False if jpegtran fails, e.g. on
+    a JPEG feature it doesn't support, so the crop is re-encoded instead"""
+    try:
+        return lossless_crop_file(src_file, dst_file, box, resize)
+    except subprocess.CalledProcessError as e:
+        logger.warning(
+            "jpegtran failed on {}, re-encoding instead: {}".format(
+                src_file, e.stderr.decode(errors="replace").strip() or e
+            )
+        )
+    except OSError as e:
+        logger.warning(
+            "jpegtran failed on {}, re-encoding instead: {}".format(src_file, e)
+        )
+    return False
+
+
+def resize_file(src_file, dst_file, settings):
+    crop_file(src_file, dst_file, None, settings)
+
+
+def stored_settings(settings, orientation):
+    "Returns settings with the resize sizes swapped if the image is stored sideways"
+    if orientation < 5:
+        return settings
+    settings = dict(settings)
+    if settings.get("resize"):
+        settings["resize"] = settings["resize"][::-1]
+    if settings.get("renditions"):
+        settings["renditions"] = [
+            dict(rendition, size=rendition["size"][::-1])
+            for rendition in settings["renditions"]
+        ]
+    return settings
+
+
+def source_orientation(src_file, settings, image=None, reader=None):
+    """Returns the EXIF orientation and size of the pixels that will be cropped.
+    Pillow turns TIFFs upright as it decodes them, while ImageMagick, jpegtran
+    and the tiled readers crop them as stored."""
+    if image is not None:
+        return exif.orientation(image), image.size
+    if reader is not None:
+        return reader.exif_orientation, reader.size
+    with Image.open(src_file) as source:
+        if settings["backend"] == "pillow":
+            return exif.orientation(source), source.size
+        return exif.stored_orientation(source), exif.stored_size(source)
+
+
+def crop_file(src_file, dst_file, box, settings, image=None):
+    """Writes the box region of src_file to dst_file with the given settings
+    from Cropper.settings(). A box of None keeps the whole image. With the
+    pillow backend, an already decoded image of src_file can be given to avoid
+    decoding it again.
+
+    The box is in the image shown upright for its EXIF orientation. It is
+    mapped to the stored image, which is cropped and shrunk as is, and only
+    the result is turned upright."""
+    # Imported here as it needs numpy, which the GUI process only wants once
+    # the first image is decoding
+    import tiles
+
+    reader = None
+    if image is None:
+        # Huge images are cropped from tiles with Pillow whatever the backend,
+        # as ImageMagick would decode them whole
+        reader = tiles.open_reader(src_file, settings.get("tiled_megapixels"))
+    try:
+        orientation, size = source_orientation(src_file, settings, image, reader)
+        if orientation != 1:
+            if box is not None:
+                box = unorient_coords(box, size, orientation)
+            settings = stored_settings(settings, orientation)
+        if settings.get("renditions"):
+            logger.info(
+                "Writing {} renditions of {}".format(
+                    len(settings["renditions"]), dst_file
+                )
+            )
+            crop_renditions(
+                src_file, dst_file, box, settings, image, reader, orientation
+            )
+            return
+        dst_file = output_file(dst_file, settings)
+        make_parent_dirs(dst_file)
+        resize = settings["resize"]
+        logger.info(
+            "Writing {}, crop {} {}".format(
+                dst_file,
+                "{}x{}+{}+{}".format(box[2] - box[0], box[3] - box[1], box[0], box[1])
+                if box
+                else "none",
+                "{}x{}>".format(*resize) if resize else "no resize",
+            )
+        )
+        # jpegtran keeps the EXIF orientation, so its crop of the stored image
+        # shows upright
+        if settings.get("lossless_jpeg") and lossless_crop(
+            src_file, dst_file, box, resize
+        ):
+            return
+        if reader is not None:
+            tiled_crop_file(reader, dst_file, box, settings, orientation)
+            return
+        if settings["backend"] == "pillow":
+            if image is not None:
+                pillow_save(
+                    exif.upright(pillow_crop_image(image, box, resize), orientation),
+                    dst_file,
+                    settings,
+                )
+            else:
+                pillow_crop_file(src_file, dst_file, box, settings, orientation)
+        else:
+            wand_crop_file(src_file, dst_file, box, settings)
+    finally:
+        if reader is not None:
+            reader.close()
+
+
+def copy_file(src_file, dst_file, settings=None):
+    make_parent_dirs(dst_file)
+    shutil.copy(src_file, dst_file)
+
 
 class Cropper:
-    def __init__(self, config):
+    def __init__(self, config, interactive=True, overwrite=False):
         self.config = config
 
-    def can_replace(self, dst_file):
-        ask = self.config.getboolean("cropper", "confirm_overwrite")
-        exists = os.path.exists(dst_file)
+        # When not interactive, e.g. in batch mode, existing files are skipped
+        # rather than asking to overwrite them
+        self.interactive = interactive
+
+        # Replace existing files without asking, e.g. for --force
+        self.overwrite = overwrite
+
+    def confirm_overwrite(self):
+        return not self.overwrite and self.config.getboolean(
+            "cropper", "confirm_overwrite"
+        )
+
+    def can_replace(self, dst_file, exists=None):
+        ask = self.confirm_overwrite()
+        if exists is None:
+            exists = os.path.exists(dst_file)
         if ask and exists:
+            if not self.interactive:
+                logger.warning(
+                    f"Skipping {dst_file}, it already exists (disable confirm_overwrite to replace it)"
+                )
+                return False
+            from tkinter import messagebox
+
             return messagebox.askokcancel(
                 f"File exists. Overwrite?",
                 f"{dst_file} already exists. Are you sure you want to overwrite it? (disable asking in options)",
             )
         return True
 
-    def resize(self, src_file, dst_file):
-        if not self.can_replace(dst_file):
+    def can_replace_all(self, dst_files):
+        "Like can_replace() for many existing dst_files, asking just once"
+        if not self.confirm_overwrite():
+            return True
+        if not self.interactive:
+            logger.warning(
+                f"Skipping {len(dst_files)} files that already exist (disable confirm_overwrite to replace them)"
+            )
             return False
-        with wand.image.Image(filename=src_file) as img:
-            img.transform(
-                resize="{}x{}>".format(
-                    self.config["cropper"]["resize_width"],
-                    self.config["cropper"]["resize_height"],
-                )
+        from tkinter import messagebox
+
+        return messagebox.askyesno(
+            f"Files exist. Overwrite?",
+            f"{len(dst_files)} output files already exist, e.g. {dst_files[0]}. Overwrite them? Choosing no skips them.",
+        )
+
+    def resize_size(self):
+        "Returns the (width, height) that resized images must fit in"
+        return [
+            self.config.getint("cropper", "resize_width"),
+            self.config.getint("cropper", "resize_height"),
+        ]
+
+    def renditions(self):
+        "Returns the [rendition.NAME] sections listed in renditions as dicts"
+        result = []
+        for name in self.config["cropper"].get("renditions", "").split(","):
+            name = name.strip()
+            if not name:
+                continue
+            section = self.config["rendition." + name]
+            result.append(
+                {
+                    "name": name,
+                    "size": [
+                        section.getint("width", 0),
+                        section.getint("height", 0),
+                    ],
+                    "format": section.get("format", "").strip().lstrip(".").lower(),
+                    "quality": section.getint("quality", 0),
+                    "subfolder": section.get("subfolder", name),
+                }
             )
-            img.save(filename=dst_file)
+        return result
+
+    def settings(self, operation):
+        """Returns the options for operation as a plain dict, which is passed to
+        the export functions and recorded in the manifest to detect stale
+        exports. Narrow it to one file's formats with job_settings()."""
+        if operation == "copy":
+            return {}
+        resize = self.resize_size()
+        if operation == "crop" and not self.config.getboolean("cropper", "resize"):
+            resize = None
+        settings = {
+            "backend": self.config["cropper"]["backend"],
+            "resize": resize,
+            "lossless_jpeg": operation == "crop"
+            and self.config.getboolean("cropper", "lossless_jpeg"),
+            "tiled_megapixels": self.config.getfloat("cropall", "tiled_megapixels"),
+            "format": self.config["cropper"]
+            .get("output_format", "")
+            .strip()
+            .lstrip(".")
+            .lower(),
+            "encoder": self.config["cropper"].get("encoder", "backend"),
+            "encoders": self.encoders(),
+        }
+        renditions = self.renditions()
+        if renditions:
+            settings["renditions"] = renditions
+        return settings
+
+    def encoders(self):
+        "Returns the [encoder.NAME] options that are set, by Pillow format name"
+        result = {}
+        for name, (fmt, types) in ENCODERS.items():
+            section = "encoder." + name
+            if section not in self.config:
+                continue
+            options = {}
+            for key, kind in types.items():
+                value = self.config[section].get(key, "").strip()
+                if not value:
+                    continue
+                if kind is int:
+                    options[key] = self.config.getint(section, key)
+                elif kind is bool:
+                    options[key] = self.config.getboolean(section, key)
+                else:
+                    options[key] = value
+            result[fmt] = options
+        return result
+
+    def outputs_exist(self, dst_file, settings):
+        return any(os.path.exists(path) for path in output_files(dst_file, settings))
+
+    def resize(self, src_file, dst_file):
+        settings = self.settings("resize")
+        if not self.can_replace(dst_file, self.outputs_exist(dst_file, settings)):
+            return False
+        with metrics.span("cropper.resize"):
+            resize_file(src_file, dst_file, settings)
         return True
 
-    def crop(self, src_file, dst_file, box):
-        if not self.can_replace(dst_file):
+    def crop(self, src_file, dst_file, box, image=None):
+        settings = self.settings("crop")
+        if not self.can_replace(dst_file, self.outputs_exist(dst_file, settings)):
             return False
-        with wand.image.Image(filename=src_file) as img:
-            crop = "{}x{}+{}+{}".format(
-                box[2] - box[0], box[3] - box[1], box[0], box[1]
-            )
-            img.transform(crop=crop)
-            resize = "no resize"
-            if self.config.getboolean("cropper", "resize"):
-                resize = "{}x{}>".format(
-                    self.config["cropper"]["resize_width"],
-                    self.config["cropper"]["resize_height"],
-                )
-                img.transform(resize=resize)
-            logger.info(f"Writing {dst_file}, crop {crop} {resize}")
-            img.save(filename=dst_file)
+        with metrics.span("cropper.crop"):
+            crop_file(src_file, dst_file, box, settings, image)
         return True
 
     def copy(self, src_file, dst_file):
         if not self.can_replace(dst_file):
             return False
-        shutil.copy(src_file, dst_file)
+        with metrics.span("cropper.copy"):
+            copy_file(src_file, dst_file)
         return True
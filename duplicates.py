@@ -0,0 +1,248 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Finds exact and near duplicate images, e.g. the same photo exported twice or
+# burst frames. Perceptual hashes are computed from small decodes in a process
+# pool and kept in an index file keyed by each image's path, modification time
+# and size, so only new or changed images are decoded the next time. Similar
+# hashes are grouped with a banded index, which only compares images that share
+# part of their hash rather than every pair.
+
+import os
+import json
+import logging
+import threading
+import concurrent.futures
+import pools
+import phash
+import metrics
+
+logger = logging.getLogger("cropall")
+
+
+class HashIndex:
+    """Perceptual hashes of images, saved as JSON and keyed by path, mtime and
+    size. An empty path keeps them in memory only."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path.strip())
+        self.lock = threading.Lock()
+        self.entries = {}
+        if not self.path:
+            return
+        try:
+            with open(self.path) as filehandle:
+                self.entries = json.load(filehandle)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring hash index {}: {}".format(self.path, e))
+
+    def get(self, path):
+        "Returns the hash of path, or None if it is not indexed or has changed"
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(os.path.abspath(path))
+        if entry is None or entry[:2] != [stat.st_mtime_ns, stat.st_size]:
+            return None
+        return int(entry[2], 16)
+
+    def put(self, path, hash):
+        stat = os.stat(path)
+        with self.lock:
+            self.entries[os.path.abspath(path)] = [
+                stat.st_mtime_ns,
+                stat.st_size,
+                "{:016x}".format(hash),
+            ]
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            entries = dict(self.entries)
+        temp = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(temp, "w") as filehandle:
+                json.dump(entries, filehandle)
+            os.replace(temp, self.path)
+        except OSError as e:
+            logger.warning("Failed to write hash index {}: {}".format(self.path, e))
+
+
+def hash_files(paths, tiled_megapixels=0):
+    "Returns the dhash of each path, or None if it can't be read. Runs in a worker process."
+    hashes = []
+    for path in paths:
+        try:
+            hashes.append(phash.hash_file(path, tiled_megapixels)[1])
+        except Exception:
+            hashes.append(None)
+    return hashes
+
+
+def index_images(
+    paths, index, tiled_megapixels=0, processes=0, chunk=32, cancelled=None
+):
+    """Returns the hash of each path, or None if it can't be read. Hashes not
+    in index are computed in a process pool, chunk images per job, and added.
+    Stops early, leaving the rest None, if the cancelled Event is set."""
+    hashes = []
+    for path in paths:
+        try:
+            hashes.append(index.get(path))
+        except OSError:
+            hashes.append(None)
+    missing = [i for i, hash in enumerate(hashes) if hash is None]
+    if not missing:
+        return hashes
+    logger.info("Hashing {} images".format(len(missing)))
+    with pools.process_pool(processes) as pool:
+        jobs = {}
+        for start in range(0, len(missing), chunk):
+            part = missing[start : start + chunk]
+            future = pool.submit(hash_files, [paths[i] for i in part], tiled_megapixels)
+            jobs[future] = part
+        for future in concurrent.futures.as_completed(jobs):
+            if cancelled is not None and cancelled.is_set():
+                pool.shutdown(wait=False, cancel_futures=True)
+                break
+            for i, hash in zip(jobs[future], future.result()):
+                hashes[i] = hash
+                if hash is None:
+                    logger.warning("Failed to hash {}".format(paths[i]))
+                    continue
+                try:
+                    index.put(paths[i], hash)
+                except OSError:
+                    pass
+    index.save()
+    return hashes
+
+
+class BandIndex:
+    """Finds hashes within threshold bits of each other. The bits are split
+    into threshold + 1 bands, and by the pigeonhole principle two hashes that
+    differ in at most threshold bits are equal in at least one band. Only
+    hashes that share a band are compared."""
+
+    def __init__(self, threshold, bits=phash.HASH_SIZE * phash.HASH_SIZE):
+        self.threshold = threshold
+        count = min(threshold + 1, bits)
+        edges = [bits * i // count for i in range(count + 1)]
+        self.bands = [
+            (low, (1 << (high - low)) - 1) for low, high in zip(edges, edges[1:])
+        ]
+        self.buckets = [{} for band in self.bands]
+
+    def add(self, hash, item):
+        for (shift, mask), buckets in zip(self.bands, self.buckets):
+            buckets.setdefault((hash >> shift) & mask, []).append((hash, item))
+
+    def find(self, hash):
+        "Returns the items with hashes at most threshold bits from hash"
+        found = {}
+        for (shift, mask), buckets in zip(self.bands, self.buckets):
+            for other, item in buckets.get((hash >> shift) & mask, ()):
+                if phash.distance(hash, other) <= self.threshold:
+                    found[id(item)] = item
+        return list(found.values())
+
+
+def group(hashes, threshold):
+    """Returns lists of the indices of hashes that are within threshold bits of
+    each other, directly or through others in the group, in order. Only groups
+    of two or more are returned and None hashes are left out."""
+    parents = list(range(len(hashes)))
+
+    def root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    index = BandIndex(threshold)
+    for i, hash in enumerate(hashes):
+        if hash is None:
+            continue
+        for j in index.find(hash):
+            parents[root(i)] = root(j)
+        index.add(hash, i)
+
+    groups = {}
+    for i, hash in enumerate(hashes):
+        if hash is not None:
+            groups.setdefault(root(i), []).append(i)
+    return [members for members in groups.values() if len(members) > 1]
+
+
+def duplicates_of(items, hashes, threshold):
+    """Returns {item: first item of its group} for every item that is a
+    duplicate of an earlier one"""
+    duplicates = {}
+    for members in group(hashes, threshold):
+        for i in members[1:]:
+            duplicates[items[i]] = items[members[0]]
+    return duplicates
+
+
+class DuplicateFinder:
+    "Indexes images and groups their duplicates in a background thread"
+
+    def __init__(self, config, input_folder, images):
+        self.input_folder = input_folder
+        self.images = list(images)
+        self.index = HashIndex(config["gui"]["hash_index"])
+        self.threshold = config.getint("gui", "duplicate_threshold")
+        self.tiled_megapixels = config.getfloat("cropall", "tiled_megapixels")
+        self.processes = config.getint("gui", "hash_processes")
+        self.cancelled = threading.Event()
+        self.duplicates = None
+        self.thread = threading.Thread(target=self.run, name="duplicates", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        paths = [os.path.join(self.input_folder, image) for image in self.images]
+        try:
+            with metrics.span("duplicates.index"):
+                hashes = index_images(
+                    paths,
+                    self.index,
+                    self.tiled_megapixels,
+                    self.processes,
+                    cancelled=self.cancelled,
+                )
+        except Exception as e:
+            logger.error("Failed to find duplicates: {}".format(e))
+            self.duplicates = {}
+            return
+        duplicates = duplicates_of(self.images, hashes, self.threshold)
+        logger.info(
+            "Found {} duplicates of {} images".format(len(duplicates), len(self.images))
+        )
+        self.duplicates = duplicates
+
+    def poll(self):
+        "Returns {image: first image of its group} once done, otherwise None"
+        return self.duplicates
+
+    def cancel(self):
+        self.cancelled.set()
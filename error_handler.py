@@ -18,7 +18,6 @@
 import sys
 import logging
 import traceback
-from tkinter.messagebox import showerror
 from functools import partial
 
 
@@ -31,6 +30,8 @@ def handle_exception(logger, exc_type, exc_value, exc_traceback):
 
     # Error popup for windows, where the console is just closed immediately
     if sys.platform == "win32":
+        from tkinter.messagebox import showerror
+
         showerror(
             "Uncaught exception",
             "\n".join(traceback.format_exception(exc_type, exc_value, exc_traceback)),
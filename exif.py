@@ -0,0 +1,70 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# EXIF orientation. Photos from phones and cameras are often stored sideways
+# with a tag saying how to turn them upright. Rather than transposing whole
+# decoded images, crop boxes are mapped to the stored image with
+# box.unorient_coords() and only the small display, preview and output images
+# are turned upright.
+
+from PIL import Image
+
+TAG = 0x0112
+
+# The transpose that shows a stored image upright, as in ImageOps.exif_transpose()
+TRANSPOSES = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+
+def stored_orientation(image):
+    """Returns the EXIF orientation of an opened PIL image, 1 if it has none.
+    This is how the pixels are stored, e.g. as ImageMagick and the tiled
+    readers see them."""
+    try:
+        value = image.getexif().get(TAG, 1)
+    except Exception:
+        return 1
+    return value if value in TRANSPOSES else 1
+
+
+def orientation(image):
+    """Returns the orientation still to apply once Pillow decodes an opened
+    image. Pillow already turns TIFFs upright as it loads them."""
+    if image.format == "TIFF":
+        return 1
+    return stored_orientation(image)
+
+
+def stored_size(image):
+    "Returns the size of an opened image as stored. Pillow gives TIFFs their upright size."
+    if image.format == "TIFF" and stored_orientation(image) in (5, 6, 7, 8):
+        return image.size[::-1]
+    return image.size
+
+
+def upright(image, orientation):
+    "Returns image transposed for its EXIF orientation, or image itself for 1"
+    if orientation not in TRANSPOSES:
+        return image
+    return image.transpose(TRANSPOSES[orientation])
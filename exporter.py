@@ -0,0 +1,230 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import concurrent.futures
+from functools import partial
+import pools
+import cropper
+import metrics
+import manifest
+
+logger = logging.getLogger("cropall")
+
+# Returned by ExportQueue.export() instead of a future for a job whose output
+# is already up to date. It is true, so callers move on as if it was queued.
+UP_TO_DATE = object()
+
+
+class ExportQueue:
+    """Runs Cropper jobs in a process pool so the caller can move on immediately.
+
+    Overwrite checks and settings are taken when a job is queued, so workers
+    never need to ask the user anything. The crop(), resize() and copy()
+    methods return the job's future, UP_TO_DATE if it was skipped by the
+    manifest, or None if the user chose not to overwrite an existing file.
+
+    If a manifest is given, finished jobs are recorded in it and jobs whose
+    output is already up to date are skipped unless skip_unchanged is False.
+
+    Crops may pass the already decoded source image. With the pillow backend
+    these run in a thread instead so the image is not decoded again."""
+
+    def __init__(self, cropper, workers=None, manifest=None, skip_unchanged=True):
+        self.cropper = cropper
+        self.manifest = manifest
+        self.skip_unchanged = skip_unchanged
+        if workers is None:
+            workers = cropper.config.getint("cropper", "export_processes")
+        self.pool = pools.process_pool(workers)
+        self.threads = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="export"
+        )
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.failed = []
+        self.completed = 0
+
+    def exists(self, dst_file, settings):
+        "Returns True if the job's outputs exist or are about to be written"
+        with self.lock:
+            if str(dst_file) in self.pending:
+                return True
+        return self.cropper.outputs_exist(dst_file, settings)
+
+    def can_replace(self, dst_file, settings):
+        return self.cropper.can_replace(
+            dst_file, exists=self.exists(dst_file, settings)
+        )
+
+    def submit(
+        self, operation, function, src_file, dst_file, *args, record=None, pool=None
+    ):
+        """Queues function(src_file, dst_file, *args), returning the future.
+        record holds the manifest fields to write once it succeeds. The job is
+        timed as cropper.<operation> for --profile."""
+        key = str(dst_file)
+        pool = pool or self.pool
+        future = pool.submit(
+            metrics.measure,
+            "cropper." + operation,
+            function,
+            src_file,
+            dst_file,
+            *args,
+        )
+        with self.lock:
+            self.pending[key] = future
+        future.add_done_callback(partial(self.on_done, key, record))
+        return future
+
+    def make_record(self, operation, src_file, dst_file, settings, box=None):
+        "Returns the manifest fields for a job, or None without a manifest"
+        if self.manifest is None:
+            return None
+        return dict(
+            dst_file=dst_file,
+            operation=operation,
+            source=manifest.source_stat(src_file),
+            settings=settings,
+            box=box,
+        )
+
+    def is_current(self, record):
+        "Returns True if the job's output is up to date and can be skipped"
+        if record is None or not self.skip_unchanged:
+            return False
+        outputs = cropper.output_files(record["dst_file"], record["settings"])
+        if self.manifest.is_current(**record, outputs=outputs):
+            logger.info("Skipping {}, already up to date".format(record["dst_file"]))
+            return True
+        return False
+
+    def export(self, operation, function, src_file, dst_file, *args, image=None):
+        """Checks the manifest and for overwrites, then submits
+        function(src_file, dst_file, *args, settings)"""
+        settings = cropper.job_settings(dst_file, self.cropper.settings(operation))
+        record = self.make_record(
+            operation,
+            src_file,
+            dst_file,
+            settings,
+            box=args[0] if operation == "crop" else None,
+        )
+        if self.is_current(record):
+            return UP_TO_DATE
+        if not self.can_replace(dst_file, settings):
+            return None
+        if image is not None and settings.get("backend") == "pillow":
+            # Decoded images can only be shared with threads, not processes
+            return self.submit(
+                operation,
+                function,
+                src_file,
+                dst_file,
+                *args,
+                settings,
+                image,
+                record=record,
+                pool=self.threads,
+            )
+        return self.submit(
+            operation, function, src_file, dst_file, *args, settings, record=record
+        )
+
+    def on_done(self, key, record, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed.append((key, error))
+        if error is not None:
+            logger.error("Failed to write {}: {}".format(key, error))
+            return
+        if metrics.registry.enabled:
+            metrics.registry.record(future.result())
+        if record is not None:
+            self.manifest.record(**record)
+
+    def resize(self, src_file, dst_file):
+        return self.export("resize", cropper.resize_file, src_file, dst_file)
+
+    def crop(self, src_file, dst_file, box, image=None):
+        return self.export(
+            "crop", cropper.crop_file, src_file, dst_file, box, image=image
+        )
+
+    def copy(self, src_file, dst_file):
+        return self.export("copy", cropper.copy_file, src_file, dst_file)
+
+    def export_all(self, operation, jobs):
+        """Queues operation, "resize", "copy" or "crop", for each (src_file,
+        dst_file) in jobs, or (src_file, dst_file, box) for crops. Up to date
+        outputs are skipped and overwriting the others is asked about once for
+        all of them. Returns the futures of the queued jobs and the number
+        skipped."""
+        function = {
+            "resize": cropper.resize_file,
+            "copy": cropper.copy_file,
+            "crop": cropper.crop_file,
+        }[operation]
+        common = self.cropper.settings(operation)
+        queued = []
+        for src_file, dst_file, *args in jobs:
+            settings = cropper.job_settings(dst_file, common)
+            record = self.make_record(
+                operation,
+                src_file,
+                dst_file,
+                settings,
+                box=args[0] if operation == "crop" else None,
+            )
+            if not self.is_current(record):
+                queued.append((src_file, dst_file, args, settings, record))
+        existing = [
+            dst_file
+            for src_file, dst_file, args, settings, record in queued
+            if self.exists(dst_file, settings)
+        ]
+        if existing and not self.cropper.can_replace_all(existing):
+            existing = set(str(dst_file) for dst_file in existing)
+            queued = [job for job in queued if str(job[1]) not in existing]
+        futures = [
+            self.submit(
+                operation, function, src_file, dst_file, *args, settings, record=record
+            )
+            for src_file, dst_file, args, settings, record in queued
+        ]
+        return futures, len(jobs) - len(futures)
+
+    def counts(self):
+        "Returns the number of (pending, failed) jobs"
+        with self.lock:
+            return len(self.pending), len(self.failed)
+
+    def shutdown(self, wait=True):
+        pending, failed = self.counts()
+        if wait and pending:
+            logger.info("Waiting for {} exports to finish".format(pending))
+        self.threads.shutdown(wait=wait)
+        self.pool.shutdown(wait=wait)
@@ -29,14 +29,18 @@
 #       or on linux install python-pillow and python-pillow-tk http://stackoverflow.com/questions/10630736/no-module-named-image-tk
 
 import os
+import math
+import bisect
 import logging
+import functools
 import box
-import numpy as np
+import loader
+import metrics
+import exporter
+import manifest
 from tkinter import *
 from tkinter.ttk import *
-from ttkthemes import ThemedTk
 from tkinter.messagebox import showinfo
-from PIL import ImageOps
 from PIL import ImageTk
 from PIL import Image
 
@@ -46,25 +50,129 @@ logger = logging.getLogger("cropall")
 logger.setLevel(logging.DEBUG)
 
 
+class BulkProgress(Toplevel):
+    "Shows the progress of a bulk resize or copy and lets it be cancelled"
+
+    def __init__(self, parent, title, futures, skipped):
+        super().__init__(parent)
+        self.title(title)
+        self.futures = futures
+        self.skipped = skipped
+        self.cancelled = False
+        self.status = StringVar()
+        self.progress = Progressbar(
+            self, length=300, maximum=max(1, len(futures)), mode="determinate"
+        )
+        self.progress.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
+        Label(self, textvariable=self.status).grid(row=1, column=0, padx=10)
+        self.button = Button(self, text="Cancel", command=self.cancel)
+        self.button.grid(row=2, column=0, pady=10)
+        self.protocol("WM_DELETE_WINDOW", self.cancel)
+        self.update_progress()
+
+    def update_progress(self):
+        done = [future for future in self.futures if future.done()]
+        failed = sum(
+            1
+            for future in done
+            if not future.cancelled() and future.exception() is not None
+        )
+        self.progress["value"] = len(done)
+        status = "{} of {} done".format(len(done), len(self.futures))
+        if self.skipped:
+            status += ", {} skipped".format(self.skipped)
+        if failed:
+            status += ", {} failed".format(failed)
+        if self.cancelled:
+            status += ", cancelled"
+        self.status.set(status)
+        if len(done) < len(self.futures):
+            self.after(200, self.update_progress)
+        else:
+            self.button.configure(text="Close", command=self.destroy)
+            self.protocol("WM_DELETE_WINDOW", self.destroy)
+
+    def cancel(self):
+        # Jobs already running in a worker finish, the rest are dropped
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+
+
+@functools.lru_cache(maxsize=16)
+def crop_widths(aspect_width, aspect_height, image_width, perfect_pixel_ratio):
+    """Returns the sorted crop widths the scroll selection can take. With
+    perfect_pixel_ratio these are the multiples of aspect_width / gcd, the only
+    widths with a whole number height. A range, so it takes no memory and can be
+    searched with bisect."""
+    step = 1
+    if perfect_pixel_ratio:
+        step = aspect_width // math.gcd(aspect_width, aspect_height)
+    return range(step, image_width + 1, step)
+
+
+def scroll_crop_box(image_box, image_size, mouse_position, crop_size):
+    """Returns the crop box of crop_size in the original image, centered on
+    the mouse position in the image_box the image is drawn in"""
+    region = box.Box2D(
+        ((mouse_position - image_box.offset) * image_size) / image_box.size,
+        crop_size,
+    )
+    region.offset -= (region.size / 2).astype(int)
+    return region.clamped(image_size)
+
+
 def clamp(x, a, b):
     return min(max(x, a), b)
 
 
-class App(ThemedTk):
-    def __init__(self, config, cropper, input_folder, images, output_folder):
-        super().__init__(theme="breeze")
+class App(Tk):
+    def __init__(
+        self, config, cropper, input_folder, images, output_folder, scanner=None
+    ):
+        super().__init__()
 
         self.configfile = config
         self.cropper = cropper
         self.input_folder = input_folder
         self.images = images
+        self.scanner = scanner
         self.output_folder = output_folder
+        self.manifest = manifest.Manifest(output_folder)
+        self.exporter = exporter.ExportQueue(cropper, manifest=self.manifest)
 
         self.wm_title("cropall")
 
         # Initial size based on screen dpi
         dpi = self.winfo_fpixels("1i")
-        self.geometry("{}x{}".format(int(dpi * 16), int(dpi * 8)))
+        window_size = box.Size2D(int(dpi * 16), int(dpi * 8))
+        self.geometry("{}x{}".format(*window_size))
+
+        logger.warning("Checking for existing crops")
+
+        # One read of the manifest, or a listing of output folders written
+        # before the manifest existed
+        if self.manifest.exists:
+            exported = self.manifest.exported()
+        else:
+            exported = manifest.existing_outputs(self.output_folder)
+        self.current = 0
+        while self.current < len(self.images) and self.images[self.current] in exported:
+            logger.warning(
+                "Skipping " + self.images[self.current] + ". Already cropped."
+            )
+            self.current += 1
+
+        # Decode the first image while the window is built, for the image area
+        # on_resize() will set at this window size. If the window manager picks
+        # another size it is decoded again.
+        self.prefetcher = loader.Prefetcher(config, input_folder, images)
+        self.prefetcher.start(
+            self.images[self.current % len(self.images)],
+            (window_size[0] / 2, window_size[1]),
+        ).add_done_callback(lambda future: metrics.mark("first image decoded"))
+
+        self.set_theme(config["gui"]["theme"])
 
         logger.info("Initializing GUI")
 
@@ -86,10 +194,23 @@ class App(ThemedTk):
         self.grid_rowconfigure(0, weight=1)
         self.grid_columnconfigure(0, weight=1)
 
-        self.image_orig = None
         self.image = None
+        self.loaded = None
+        self.duplicate_finder = None
+        self.duplicates_id = None
+        self.similar_id = None
         self.delayed_resize_id = None
         self.preview = None
+        self.previewPhoto = None
+
+        # Layout of the image on the canvas, updated by update_layout()
+        self.image_size = None
+        self.image_box = None
+
+        # Pending coalesced redraws, see schedule_redraw()
+        self.redraw_id = None
+        self.redraw_preview = False
+        self.final_preview_id = None
 
         self.displayed_crop_rectangle = None
         self.verti_aux_item = None
@@ -101,14 +222,13 @@ class App(ThemedTk):
 
         # "scroll" selection center and crop index
         self.scroll_crop_width = 1
-        self.current = 0
 
         self.shift_pressed = False
 
         self.controls = Frame(self)
         self.controls.grid(row=1, column=0, columnspan=2, sticky="nsew")
 
-        col = iter(range(14))
+        col = iter(range(15))
 
         selection_mode_options = ("click-drag", "scroll")
         self.selection_mode = StringVar()
@@ -156,6 +276,10 @@ class App(ThemedTk):
         self.buttons += [Button(self.controls, text="Crop", command=self.crop_next)]
         self.buttons[-1].grid(row=0, column=next(col), sticky="nsew")
 
+        self.export_status = StringVar()
+        self.export_status_label = Label(self.controls, textvariable=self.export_status)
+        self.export_status_label.grid(row=0, column=next(col), sticky="nsew")
+
         self.menubar = Menu(self)
         self.options_menu = Menu(self.menubar)
         self.fixed_aspect = IntVar()
@@ -178,11 +302,36 @@ class App(ThemedTk):
         self.options_menu.add_checkbutton(
             label="Confirm before overwriting", variable=self.confirm_overwrite
         )
+        self.keep_previous_crop = IntVar()
+        self.options_menu.add_checkbutton(
+            label="Keep Previous Crop", variable=self.keep_previous_crop
+        )
+        self.skip_duplicates = IntVar()
+        self.options_menu.add_checkbutton(
+            label="Skip Duplicates", variable=self.skip_duplicates
+        )
+        self.bulk_menu = Menu(self.menubar)
+        self.bulk_menu.add_command(label="Crop similar run", command=self.crop_similar)
+        self.bulk_menu.add_command(
+            label="Resize all", command=lambda: self.export_all("resize")
+        )
+        self.bulk_menu.add_command(
+            label="Resize remaining",
+            command=lambda: self.export_all("resize", remaining=True),
+        )
+        self.bulk_menu.add_command(
+            label="Copy all", command=lambda: self.export_all("copy")
+        )
+        self.bulk_menu.add_command(
+            label="Copy remaining",
+            command=lambda: self.export_all("copy", remaining=True),
+        )
         self.help_menu = Menu(self.menubar)
         self.help_menu.add_command(
             label="About", command=lambda: showinfo("About", about_text)
         )
         self.menubar.add_cascade(label="Options", menu=self.options_menu)
+        self.menubar.add_cascade(label="Bulk", menu=self.bulk_menu)
         self.menubar.add_cascade(label="Help", menu=self.help_menu)
         self.configure(relief="flat", background="gray", menu=self.menubar)
 
@@ -212,6 +361,12 @@ class App(ThemedTk):
         self.confirm_overwrite.set(
             1 if self.configfile.getboolean("cropper", "confirm_overwrite") else 0
         )
+        self.keep_previous_crop.set(
+            1 if self.configfile.getboolean("selection", "keep_previous_crop") else 0
+        )
+        self.skip_duplicates.set(
+            1 if self.configfile.getboolean("gui", "skip_duplicates") else 0
+        )
 
         self.aspect_vars[0].trace("w", self.on_option_changed)
         self.aspect_vars[1].trace("w", self.on_option_changed)
@@ -222,6 +377,8 @@ class App(ThemedTk):
         self.show_guides.trace("w", self.on_option_changed)
         self.resize_after_crop.trace("w", self.on_option_changed)
         self.confirm_overwrite.trace("w", self.on_option_changed)
+        self.keep_previous_crop.trace("w", self.on_option_changed)
+        self.skip_duplicates.trace("w", self.on_option_changed)
         self.selection_mode.trace("w", self.on_option_changed)
         self.bind("<Configure>", self.on_resize)
         self.bind("<space>", self.crop_next)
@@ -239,23 +396,38 @@ class App(ThemedTk):
         self.bind("<Button-5>", self.on_mouse_scroll)
         self.bind("<MouseWheel>", self.on_mouse_scroll)
 
-        logger.warning("Checking for existing crops")
-        self.current = 0
-        while self.current < len(self.images) and os.path.exists(
-            os.path.join(self.output_folder, self.images[self.current])
-        ):
-            logger.warning(
-                "Skipping " + self.images[self.current] + ". Already cropped."
-            )
-            self.current += 1
+        metrics.mark("window created")
 
         # Trigger a resize to set self.display_area
         self.display_area = box.Size2D(-1, -1)
         self.update()
+        metrics.mark("window shown")
 
         # Load the first image
         self.current += 1
         self.previous()
+        metrics.mark("first image shown")
+        self.after_idle(metrics.mark, "interactive")
+
+        self.update_export_status()
+        self.poll_scanner()
+        self.find_duplicates()
+
+    def set_theme(self, theme):
+        """Uses a built in ttk theme, or one from ttkthemes, which is only
+        imported if needed. An empty theme keeps Tk's default."""
+        if not theme:
+            return
+        style = Style(self)
+        if theme in style.theme_names():
+            style.theme_use(theme)
+            return
+        try:
+            from ttkthemes import ThemedStyle
+        except ImportError:
+            logger.warning("Install ttkthemes to use the {} theme".format(theme))
+            return
+        ThemedStyle(self).set_theme(theme)
 
     def aspect(self):
         try:
@@ -273,9 +445,14 @@ class App(ThemedTk):
             (self.scroll_crop_width * aspect[1]) / aspect[0],
         )
 
+    def update_layout(self):
+        "Computes where the image is drawn, which only changes with the image or window size"
+        if self.image_size is not None:
+            self.image_box = box.Box2D.scale_down(self.image_size, self.image_area)
+
     def image_crop_box(self):
         "Returns the crop box for the original image"
-        image_box = box.Box2D.scale_down(self.image_size, self.image_area)
+        image_box = self.image_box
 
         if self.selection_mode.get() == "click-drag":
             image_mouse_box = (self.mouse_selection - image_box).scaled(
@@ -289,89 +466,266 @@ class App(ThemedTk):
             else:
                 return image_mouse_box.positive_size()
         else:
-            # scroll to change size
-            region = box.Box2D(
-                ((self.mouse_position - image_box.offset) * self.image_size)
-                / image_box.size,
-                self.scroll_crop_size(),
-            )
-            region.offset -= (region.size / 2).astype(int)
-            return region.clamped(self.image_size)
+            return self.scroll_crop_box()
+
+    def scroll_crop_box(self):
+        "Returns the crop box of the scroll selection mode in the original image"
+        return scroll_crop_box(
+            self.image_box,
+            self.image_size,
+            self.mouse_position,
+            self.scroll_crop_size(),
+        )
 
-    def displayed_crop_box(self):
+    def displayed_crop_box(self, orig_crop=None):
         "Returns the crop box for the possibly-scaled displayed image, relative to the image_box area, not the whole image_area"
-        image_box = box.Box2D.scale_down(self.image_size, self.image_area)
-        orig_crop = self.image_crop_box()
-        display_crop = orig_crop.scaled(self.image_size, image_box.size)
+        if orig_crop is None:
+            orig_crop = self.image_crop_box()
+        display_crop = orig_crop.scaled(self.image_size, self.image_box.size)
         return display_crop
 
     def previous(self, event=None):
-        self.current -= 1
-        self.current = (self.current + len(self.images)) % len(self.images)
-        self.load_imgfile(self.images[self.current])
+        self.advance(-1)
 
     def next(self, event=None):
-        self.current += 1
-        self.current = (self.current + len(self.images)) % len(self.images)
+        self.advance(1)
+
+    def advance(self, step):
+        "Moves step images on, passing over duplicates if they are skipped"
+        count = len(self.images)
+        for i in range(count):
+            self.current = (self.current + step + count) % count
+            if self.images[self.current] not in self.prefetcher.skip:
+                break
         self.load_imgfile(self.images[self.current])
 
     def copy_next(self):
-        if self.cropper.copy(
+        if self.exporter.copy(
             self.input_folder / self.currentName, self.output_folder / self.currentName
         ):
             self.next()
 
     def resize_next(self):
-        if self.cropper.resize(
+        if self.exporter.resize(
             self.input_folder / self.currentName, self.output_folder / self.currentName
         ):
             self.next()
 
     def crop_next(self, event=None):
         box = self.image_crop_box()
-        if self.cropper.crop(
+        if self.exporter.crop(
             self.input_folder / self.currentName,
             self.output_folder / self.currentName,
-            box.coords().tolist(),
+            box.coords(),
+            # Only decoded up front when fast_preview is off
+            image=self.loaded.image,
         ):
             self.next()
 
+    def export_all(self, operation, remaining=False):
+        """Resizes or copies every image, or those from the current one on, to
+        the output folder in the background export processes"""
+        images = self.images[self.current :] if remaining else list(self.images)
+        futures, skipped = self.exporter.export_all(
+            operation,
+            [
+                (self.input_folder / filename, self.output_folder / filename)
+                for filename in images
+            ],
+        )
+        logger.info(
+            "Queued {} {} jobs, skipped {}".format(len(futures), operation, skipped)
+        )
+        BulkProgress(self, operation.capitalize() + " all", futures, skipped)
+
+    def similar_images(self, first, run, chunk=16):
+        """Extends run, the (filename, size, hash) of images[first] onwards,
+        with the following images that each look like the one before by their
+        perceptual hashes. Only hashes already made are used. Returns True once
+        the run has ended, or False if it reached images still to be hashed,
+        which are queued in the prefetch threads."""
+        import phash
+
+        threshold = self.configfile.getint("selection", "similar_threshold")
+        while first + len(run) < len(self.images):
+            start = first + len(run)
+            filenames = self.images[start : start + chunk]
+            known = self.prefetcher.known_hashes(filenames)
+            for filename in filenames:
+                if filename not in known:
+                    self.prefetcher.hash_later(filenames)
+                    return False
+                result = known[filename]
+                if result is None or phash.distance(run[-1][2], result[1]) > threshold:
+                    return True
+                run.append((filename, result[0], result[1]))
+        return True
+
+    def crop_similar(self):
+        """Crops the current image and the run of similar images after it with
+        the same relative crop box, then moves past them"""
+        if self.similar_id is not None:
+            # Still finding the last run
+            return
+        run = [(self.currentName, tuple(self.image_size), self.loaded.hash)]
+        self.find_similar(self.current, self.image_crop_box(), run)
+
+    def find_similar(self, first, crop, run):
+        "Polls until the run is hashed, so the window stays responsive, then crops it"
+        self.similar_id = None
+        if not self.similar_images(first, run):
+            self.similar_id = self.after(50, self.find_similar, first, crop, run)
+            return
+        sizes = [size for filename, size, hash in run]
+        boxes = (
+            box.Box2DArray.repeat(crop, len(run))
+            .scaled(sizes[0], sizes)
+            .clamped(sizes)
+            .coords()
+            .tolist()
+        )
+        futures, skipped = self.exporter.export_all(
+            "crop",
+            [
+                (
+                    self.input_folder / filename,
+                    self.output_folder / filename,
+                    crop_box,
+                )
+                for (filename, size, hash), crop_box in zip(run, boxes)
+            ],
+        )
+        logger.info(
+            "Queued crops of {} similar images, skipped {}".format(
+                len(futures), skipped
+            )
+        )
+        BulkProgress(self, "Crop similar run", futures, skipped)
+        # Move past the run, unless another image was opened meanwhile
+        if self.current == first:
+            self.current += len(run) - 1
+            self.next()
+
+    def poll_scanner(self):
+        "Adds images found by a directory scan still running in the background"
+        if self.scanner is None:
+            return
+        images = self.scanner.poll()
+        if images:
+            # Extend in place, as the prefetcher shares the list
+            self.images += images
+            logger.info("{} images found so far".format(len(self.images)))
+        if not self.scanner.done():
+            self.after(100, self.poll_scanner)
+        else:
+            self.find_duplicates()
+
+    def find_duplicates(self):
+        """Starts indexing the images for duplicates if they are to be skipped
+        and the scan has finished, and updates which images are skipped"""
+        # Called again on option changes, so only one poll is ever queued
+        if self.duplicates_id is not None:
+            self.after_cancel(self.duplicates_id)
+            self.duplicates_id = None
+        if not self.skip_duplicates.get():
+            self.prefetcher.skip = set()
+            return
+        if self.duplicate_finder is None:
+            if self.scanner is not None and not self.scanner.done():
+                # Started by poll_scanner() once all images are found
+                return
+            import duplicates
+
+            self.duplicate_finder = duplicates.DuplicateFinder(
+                self.configfile, self.input_folder, self.images
+            ).start()
+        found = self.duplicate_finder.poll()
+        if found is None:
+            self.duplicates_id = self.after(250, self.find_duplicates)
+            return
+        self.prefetcher.skip = set(found)
+
+    def update_export_status(self):
+        pending, failed = self.exporter.counts()
+        status = ""
+        if pending:
+            status += "{} pending".format(pending)
+        if failed:
+            status += "{}{} failed".format(", " if status else "", failed)
+        self.export_status.set(status)
+        self.after(250, self.update_export_status)
+
+    @metrics.timed("gui.load_imgfile")
     def load_imgfile(self, filename):
+        # The crop on the image being left, in its own size, to carry over
+        previous = None
+        if self.loaded is not None and self.keep_previous_crop.get():
+            previous = (self.image_crop_box(), self.image_size)
+
         self.currentName = filename
         fullFilename = os.path.join(self.input_folder, filename)
         logger.info("Loading " + fullFilename)
-        self.image_orig = Image.open(fullFilename)
-        self.image_size = box.Size2D(self.image_orig.size[0], self.image_orig.size[1])
+        self.loaded = self.prefetcher.load(filename, self.image_area)
+
+        self.image_size = box.Size2D(self.loaded.size[0], self.loaded.size[1])
         logger.info(
             "Image is " + str(self.image_size[0]) + "x" + str(self.image_size[1])
         )
 
-        # Initialize scroll cropping
-        image_box = box.Box2D.scale_down(self.image_size, self.image_area)
+        # Initialize scroll cropping, then start from the previous image's crop
+        # or the suggested crop if there is one
+        self.update_layout()
+        image_box = self.image_box
         self.scroll_crop_width = self.image_size[0] // 2
         self.inc_scroll_crop()
         self.mouse_position = (self.image_area / 2).astype(int)
         self.mouse_selection = self.displayed_crop_box() + image_box
+        if previous is not None:
+            crop, size = previous
+            self.select_crop(
+                crop.scaled(size, self.image_size).clamped(self.image_size)
+            )
+        else:
+            suggestion = self.loaded.suggest(self.aspect())
+            if suggestion is not None:
+                self.select_crop(
+                    box.Box2D.from_min_max(
+                        self.image_size * suggestion[:2],
+                        self.image_size * suggestion[2:],
+                    )
+                )
 
         self.update_image_display()
         self.update_selection_box(self.image_label)
         self.update_preview(self.image_label)
 
+    def select_crop(self, crop):
+        """Moves the selection to crop, a Box2D in the original image. The
+        scroll selection is centred on it with the nearest valid width below."""
+        image_box = self.image_box
+        widths = self.scroll_crop_widths()
+        index = bisect.bisect_right(widths, crop.size[0])
+        if index > 0:
+            self.scroll_crop_width = widths[index - 1]
+        elif widths:
+            self.scroll_crop_width = widths[0]
+        centre = crop.offset + crop.size / 2
+        self.mouse_position = (
+            image_box.offset + centre * image_box.size / self.image_size
+        )
+        self.mouse_selection = self.displayed_crop_box(crop) + image_box
+
+    @metrics.timed("gui.update_image_display")
     def update_image_display(self):
-        if not self.image_orig:
+        if self.loaded is None:
             return
 
-        image_box = box.Box2D.scale_down(self.image_size, self.image_area)
-        if self.configfile.getboolean("gui", "fast_preview"):
-            # does NOT create a copy so self.image_orig is the same as self.image
-            self.image = self.image_orig.copy()
-            self.image.thumbnail(image_box.size, Image.NEAREST)
-        else:
-            if self.configfile.getboolean("gui", "antialiase_slow_preview"):
-                self.image = self.image_orig.resize(image_box.size, Image.LANCZOS)
-            else:
-                self.image = self.image_orig.copy()
-                self.image.thumbnail(image_box.size, Image.NEAREST)
+        image_box = self.image_box
+
+        # Usually a cache hit. Otherwise the window was resized and the display
+        # image needs to be decoded again at the new size.
+        self.loaded = self.prefetcher.load(self.currentName, self.image_area)
+        self.image = self.loaded.display
         logger.info("Resized preview")
 
         self.imagePhoto = ImageTk.PhotoImage(self.image)
@@ -381,38 +735,31 @@ class App(ThemedTk):
         )
         self.image_label.tag_lower(canva_image)
 
-    def test_fractional_size(self):
-        if self.configfile.getboolean("selection", "perfect_pixel_ratio"):
-            (w, h) = self.scroll_crop_size()
-            if int(h) != h or int(w) != w:
-                return False
-        return True
+        # Start decoding the neighbouring images while this one is worked on
+        self.prefetcher.prefetch(self.current, self.image_area)
 
-    def update_selection_box(self, widget):
+    @metrics.timed("gui.update_selection_box")
+    def update_selection_box(self, widget, crop=None):
         if not self.image or self.image_area[0] == 0:
             return
 
-        image_box = box.Box2D.scale_down(self.image_size, self.image_area)
-        selection_box = self.displayed_crop_box() + image_box
+        selection_box = self.displayed_crop_box(crop) + self.image_box
         if self.displayed_crop_rectangle is None:
             self.displayed_crop_rectangle = widget.create_rectangle(
-                selection_box.coords().tolist(),
+                selection_box.coords(),
                 outline=self.configfile["selection"]["color"],
             )
         else:
-            widget.coords(
-                self.displayed_crop_rectangle, *selection_box.coords().tolist()
-            )
+            widget.coords(self.displayed_crop_rectangle, *selection_box.coords())
 
         if self.show_guides.get() == 1:
-            verti_bbox = selection_box.copy()
-            verti_bbox.offset[0] += verti_bbox.size[0] / 3
-            verti_bbox.size[0] /= 3
-            verti_bbox = verti_bbox.coords().tolist()
-            horiz_bbox = selection_box.copy()
-            horiz_bbox.offset[1] += horiz_bbox.size[1] / 3
-            horiz_bbox.size[1] /= 3
-            horiz_bbox = horiz_bbox.coords().tolist()
+            offset, size = selection_box.offset, selection_box.size
+            verti_bbox = box.Box2D(
+                (offset[0] + size[0] / 3, offset[1]), (int(size[0] / 3), size[1])
+            ).coords()
+            horiz_bbox = box.Box2D(
+                (offset[0], offset[1] + size[1] / 3), (size[0], int(size[1] / 3))
+            ).coords()
             if self.horiz_aux_item is None:
                 self.horiz_aux_item = widget.create_rectangle(
                     horiz_bbox, outline=self.configfile["selection"]["color"]
@@ -433,33 +780,82 @@ class App(ThemedTk):
                 widget.delete(self.verti_aux_item)
                 self.verti_aux_item = None
 
-    def update_preview(self, widget):
+    @metrics.timed("gui.update_preview")
+    def update_preview(self, widget, crop=None, quick=False):
         if not self.image or self.image_area[0] == 0:
             return
-
-        # get a crop for the preview
-        if self.configfile.getboolean("gui", "fast_preview"):
-            preview = self.image.crop(self.displayed_crop_box().coords().tolist())
+        if crop is None:
+            crop = self.image_crop_box()
+
+        # get a crop for the preview. While the selection is changing, a quick
+        # low quality preview from the display image keeps up with the mouse.
+        if quick:
+            self.preview = loader.make_preview_image(
+                self.image,
+                self.displayed_crop_box(crop).coords(),
+                self.preview_area,
+                Image.BILINEAR,
+            )
+        elif self.configfile.getboolean("gui", "fast_preview"):
+            self.preview = loader.make_preview_image(
+                self.image,
+                self.displayed_crop_box(crop).coords(),
+                self.preview_area,
+            )
         else:
-            preview = self.image_orig.crop(self.image_crop_box().coords().tolist())
-
-        # Resize and letterbox
-        preview_box = box.Box2D.contain(preview.size, self.preview_area)
-        preview = preview.resize(preview_box.size, Image.LANCZOS)
-        preview = ImageOps.expand(
-            preview, border=tuple(preview_box.offset), fill=(100, 100, 100)
-        )
-        self.preview = preview
+            # Crop from the smallest pyramid level, or for huge images the
+            # overview or tiles, with enough detail, so this takes the same time
+            # whatever the source size
+            preview_size = box.Box2D.contain(crop.size, self.preview_area).size
+            image, level_crop = self.loaded.select(crop.coords(), preview_size)
+            self.preview = loader.make_preview_image(
+                image, level_crop, self.preview_area
+            )
 
-        self.previewPhoto = ImageTk.PhotoImage(self.preview)
-        self.preview_label.configure(image=self.previewPhoto)
+        # Reuse the Tk image rather than allocating a new one each update
+        if (
+            self.previewPhoto is not None
+            and self.previewPhoto.width() == self.preview.size[0]
+            and self.previewPhoto.height() == self.preview.size[1]
+        ):
+            self.previewPhoto.paste(self.preview)
+        else:
+            self.previewPhoto = ImageTk.PhotoImage(self.preview)
+            self.preview_label.configure(image=self.previewPhoto)
+
+    def schedule_redraw(self, preview=True):
+        """Redraws the selection, and optionally a quick preview, once pending
+        input events have been handled. Mouse events arrive much faster than
+        they can be drawn, so this coalesces them into one redraw."""
+        self.redraw_preview = self.redraw_preview or preview
+        if self.redraw_id is None:
+            self.redraw_id = self.after_idle(self.redraw)
+
+    def redraw(self):
+        self.redraw_id = None
+        if not self.image:
+            return
+        crop = self.image_crop_box()
+        self.update_selection_box(self.image_label, crop)
+        if self.redraw_preview:
+            self.redraw_preview = False
+            self.update_preview(self.image_label, crop, quick=True)
+
+            # Draw the full quality preview once the input goes idle
+            if self.final_preview_id:
+                self.after_cancel(self.final_preview_id)
+            self.final_preview_id = self.after(150, self.on_input_idle)
+
+    def on_input_idle(self):
+        self.final_preview_id = None
+        self.update_preview(self.image_label)
 
     def remove_focus(self, event=None):
         self.focus()
 
     def on_resize(self, event):
         new_display_area = box.Size2D(self.winfo_width(), self.winfo_height())
-        if np.array_equal(self.display_area, new_display_area):
+        if self.display_area == new_display_area:
             return
 
         # Left/right panel sizes are computed manually based off the entire
@@ -468,10 +864,9 @@ class App(ThemedTk):
         # account.
         logger.info("Resize window {}x{}".format(*new_display_area))
         self.display_area = new_display_area
-        self.image_area = self.display_area.copy()
-        self.preview_area = self.display_area.copy()
-        self.image_area[0] /= 2
-        self.preview_area[0] -= self.image_area[0]
+        self.image_area = box.Size2D(self.display_area[0] / 2, self.display_area[1])
+        self.preview_area = self.display_area - (self.image_area[0], 0)
+        self.update_layout()
         self.update_selection_box(self.image_label)
         self.update_preview(self.image_label)
 
@@ -479,7 +874,7 @@ class App(ThemedTk):
         # slow, so consolidate multiple resizes to a single delayed event.
         if self.delayed_resize_id:
             self.after_cancel(self.delayed_resize_id)
-        if self.image_orig:
+        if self.loaded is not None:
             self.delayed_resize_id = self.after(1000, self.update_image_display)
 
     def on_option_changed(self, event, var1, var2):
@@ -517,7 +912,23 @@ class App(ThemedTk):
         self.configfile["cropper"]["confirm_overwrite"] = make_bool(
             self.confirm_overwrite.get() != 0
         )
+        self.configfile["selection"]["keep_previous_crop"] = make_bool(
+            self.keep_previous_crop.get() != 0
+        )
+        self.configfile["gui"]["skip_duplicates"] = make_bool(
+            self.skip_duplicates.get() != 0
+        )
         self.configfile["selection"]["mode"] = self.selection_mode.get()
+        self.find_duplicates()
+
+    def scroll_crop_widths(self):
+        aspect = self.aspect()
+        return crop_widths(
+            aspect[0],
+            aspect[1],
+            self.image_size[0],
+            self.configfile.getboolean("selection", "perfect_pixel_ratio"),
+        )
 
     def inc_scroll_crop(self):
         # Scroll one pixel at a time if shift is pressed. Otherwise skip a few
@@ -525,20 +936,24 @@ class App(ThemedTk):
             self.scroll_crop_width = min(
                 self.image_size[0], int(self.scroll_crop_width * 1.1)
             )
-        while self.scroll_crop_width < self.image_size[0]:
-            self.scroll_crop_width += 1
-            if self.test_fractional_size():
-                break
+
+        # Step to the next valid width, or the image width if there is none
+        widths = self.scroll_crop_widths()
+        index = bisect.bisect_right(widths, self.scroll_crop_width)
+        self.scroll_crop_width = (
+            widths[index] if index < len(widths) else self.image_size[0]
+        )
         logger.info("Crop width: {}".format(self.scroll_crop_width))
 
     def dec_scroll_crop(self):
         # Scroll one pixel at a time if shift is pressed. Otherwise skip a few
         if not self.shift_pressed:
             self.scroll_crop_width = max(1, int(self.scroll_crop_width * 0.9))
-        while self.scroll_crop_width > 1:
-            self.scroll_crop_width -= 1
-            if self.test_fractional_size():
-                break
+
+        # Step to the previous valid width, or 1 if there is none
+        widths = self.scroll_crop_widths()
+        index = bisect.bisect_left(widths, self.scroll_crop_width)
+        self.scroll_crop_width = widths[index - 1] if index > 0 else 1
         logger.info("Crop width: {}".format(self.scroll_crop_width))
 
     def on_mouse_scroll(self, event):
@@ -550,8 +965,7 @@ class App(ThemedTk):
             self.dec_scroll_crop()
             changed = True
         if changed:
-            self.update_selection_box(self.image_label)
-            self.update_preview(self.image_label)
+            self.schedule_redraw()
 
     def on_mouse_down(self, event):
         self.remove_focus()
@@ -559,7 +973,7 @@ class App(ThemedTk):
         self.mouse_down_position = box.Size2D(event.x, event.y)
         self.mouse_position = box.Size2D(event.x, event.y)
 
-        self.update_selection_box(event.widget)
+        self.schedule_redraw()
 
     def on_mouse_drag(self, event):
         new_position = box.Size2D(event.x, event.y)
@@ -582,10 +996,20 @@ class App(ThemedTk):
                     self.mouse_position - self.mouse_down_position,
                 )
 
-        self.update_selection_box(event.widget)
+        self.schedule_redraw()
 
     def on_mouse_up(self, event):
-        self.update_preview(event.widget)
+        self.schedule_redraw()
+
+    def destroy(self):
+        self.prefetcher.shutdown()
+        if self.duplicate_finder is not None:
+            self.duplicate_finder.cancel()
+
+        # Exports keep running in the background. See cropall.py, which waits
+        # for them after the main loop exits.
+        self.exporter.shutdown(wait=False)
+        super().destroy()
 
     def on_shift_press(self, event):
         self.shift_pressed = True
@@ -0,0 +1,582 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import math
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+from functools import partial
+import box
+import exif
+import metrics
+import pyramid
+import preview_cache
+from PIL import Image
+from PIL import ImageOps
+
+logger = logging.getLogger("cropall")
+
+
+def make_display_image(image, size, fast_preview, antialias):
+    "Returns a copy of image shrunk to size for displaying on the main canvas"
+    size = (int(size[0]), int(size[1]))
+    if not fast_preview and antialias:
+        return image.resize(size, Image.LANCZOS)
+    if image.size == size:
+        return image
+    display = image.copy()
+    display.thumbnail(size, Image.NEAREST)
+    return display
+
+
+def make_preview_image(image, crop_box, area, resample=Image.LANCZOS):
+    "Returns the crop_box region of image, resized and letterboxed to fill area"
+    crop_size = (crop_box[2] - crop_box[0], crop_box[3] - crop_box[1])
+    preview_box = box.Box2D.contain(crop_size, area)
+    preview = image.resize(
+        tuple(int(x) for x in preview_box.size), resample, box=tuple(crop_box)
+    )
+    return ImageOps.expand(
+        preview, border=tuple(int(x) for x in preview_box.offset), fill=(100, 100, 100)
+    )
+
+
+class LoadedImage:
+    "A decoded source image and the downsized copy shown on the main canvas"
+
+    def __init__(
+        self,
+        filename,
+        size,
+        image,
+        display,
+        area,
+        options,
+        pyramid=None,
+        reader=None,
+        overview=None,
+        orientation=1,
+    ):
+        self.filename = filename
+        self.size = size
+        # The display image and size are upright. The image, pyramid, reader
+        # and overview are as stored, turned by the EXIF orientation.
+        self.orientation = orientation
+        # The full resolution image and its pyramid are only kept if the slow
+        # preview needs them. Huge images keep a tiled reader and a reduced
+        # overview instead.
+        self.image = image
+        self.pyramid = pyramid
+        self.reader = reader
+        self.overview = overview
+        self.display = display
+        self.area = area
+        self.options = options
+
+        # The crop suggestion engine's map of the display image, made in the
+        # background like the rest, and the suggested crops for each aspect.
+        # These and tiles need numpy, which is imported here rather than at
+        # startup so the window can open while the first image decodes.
+        import phash
+        import suggest
+
+        self.energy = suggest.energy_map(display, options[4])
+        self.suggestions = {}
+
+        # Perceptual hash, for finding runs of similar images
+        self.hash = phash.dhash(display)
+
+    def matches(self, area, options):
+        return self.area == area and self.options == options
+
+    def suggest(self, aspect):
+        """Returns the suggested crop for aspect as fractions of the image size,
+        or None to start with the default selection"""
+        if self.energy is None:
+            return None
+        aspect = (int(aspect[0]), int(aspect[1]))
+        if aspect not in self.suggestions:
+            import suggest
+
+            self.suggestions[aspect] = suggest.best_window(self.energy, aspect)
+        return self.suggestions[aspect]
+
+    def nbytes(self):
+        "Approximate memory used by the decoded images"
+        total = pyramid.image_bytes(self.display)
+        if self.pyramid is not None:
+            total += self.pyramid.nbytes()
+        elif self.image is not None:
+            total += pyramid.image_bytes(self.image)
+        if self.overview is not None:
+            total += pyramid.image_bytes(self.overview)
+        return total
+
+    def select(self, crop_box, size):
+        """Returns (image, box) with enough detail to resize the crop_box region
+        of the source to size, and crop_box in the returned image's coordinates.
+        crop_box and the returned image are upright."""
+        if self.orientation == 1:
+            return self.select_stored(crop_box, size)
+        stored_size = box.oriented_size(self.size, self.orientation)
+        image, region = self.select_stored(
+            box.unorient_coords(crop_box, stored_size, self.orientation),
+            box.oriented_size(size, self.orientation),
+        )
+        # Turn just the selected region upright, which is about size
+        piece = (
+            math.floor(region[0]),
+            math.floor(region[1]),
+            math.ceil(region[2]),
+            math.ceil(region[3]),
+        )
+        region = [
+            region[0] - piece[0],
+            region[1] - piece[1],
+            region[2] - piece[0],
+            region[3] - piece[1],
+        ]
+        image = image.crop(piece)
+        return exif.upright(image, self.orientation), box.orient_coords(
+            region, image.size, self.orientation
+        )
+
+    def select_stored(self, crop_box, size):
+        "Like select() in the stored image's coordinates"
+        if self.reader is None:
+            return self.pyramid.select(crop_box, size)
+        stored_size = box.oriented_size(self.size, self.orientation)
+        scale_x = self.overview.size[0] / stored_size[0]
+        scale_y = self.overview.size[1] / stored_size[1]
+        if (crop_box[2] - crop_box[0]) * scale_x >= size[0] and (
+            crop_box[3] - crop_box[1]
+        ) * scale_y >= size[1]:
+            return self.overview, [
+                crop_box[0] * scale_x,
+                crop_box[1] * scale_y,
+                crop_box[2] * scale_x,
+                crop_box[3] * scale_y,
+            ]
+        # Zoomed in past the overview, so read just the tiles under the crop
+        return self.reader.select(crop_box, size)
+
+
+def load_tiled(filename, reader, area, options, cache=None):
+    "Creates the display image of a huge image from a reduced overview of it"
+    fast_preview, antialias = options[:2]
+    start = time.perf_counter()
+    orientation = reader.exif_orientation
+    size = box.oriented_size(reader.size, orientation)
+    image_box = box.Box2D.scale_down(size, box.Size2D(*area))
+    overview_size = box.oriented_size(image_box.size, orientation)
+    if cache is not None:
+        # Also large enough for the cached preview, but never smaller than
+        # the display, whose area can be bigger than the cache resolution
+        cache_size = box.Box2D.scale_down(
+            box.Size2D(*reader.size), box.Size2D(cache.resolution, cache.resolution)
+        ).size
+        overview_size = box.Size2D(
+            max(overview_size[0], cache_size[0]), max(overview_size[1], cache_size[1])
+        )
+    with metrics.span("loader.decode_tiled"):
+        overview = reader.overview(overview_size)
+    logger.info(
+        "Read {} at {}x{} in tiles in {:.0f} ms".format(
+            filename,
+            overview.size[0],
+            overview.size[1],
+            (time.perf_counter() - start) * 1000,
+        )
+    )
+    display = exif.upright(
+        make_display_image(
+            overview,
+            box.oriented_size(image_box.size, orientation),
+            fast_preview,
+            antialias,
+        ),
+        orientation,
+    )
+    size = tuple(size)
+    if fast_preview:
+        if cache is not None:
+            cache.put(reader.path, size, overview, orientation)
+        reader.close()
+        return LoadedImage(filename, size, None, display, area, options)
+    return LoadedImage(
+        filename,
+        size,
+        None,
+        display,
+        area,
+        options,
+        reader=reader,
+        overview=overview,
+        orientation=orientation,
+    )
+
+
+@metrics.timed("loader.load_image")
+def load_image(filename, path, area, options, cache=None):
+    """Decodes path and creates its display image for a canvas of the given
+    area. The on-disk preview cache, if given, is used with fast_preview.
+    Images of at least tiled_megapixels are read in tiles if possible."""
+    fast_preview, antialias, draft, tiled_megapixels = options[:4]
+    start = time.perf_counter()
+    cache = cache if fast_preview else None
+    if cache is not None:
+        with metrics.span("preview_cache.get"):
+            hit = cache.get(path)
+        if hit is not None:
+            size, preview = hit
+            image_box = box.Box2D.scale_down(box.Size2D(*size), box.Size2D(*area))
+            # Bypass the cache if the display is bigger than the cached preview
+            if preview.size == size or max(image_box.size) <= cache.resolution:
+                logger.info(
+                    "Loaded {} from preview cache in {:.0f} ms".format(
+                        filename, (time.perf_counter() - start) * 1000
+                    )
+                )
+                display = make_display_image(preview, image_box.size, True, False)
+                return LoadedImage(filename, size, None, display, area, options)
+
+    import tiles
+
+    reader = tiles.open_reader(path, tiled_megapixels)
+    if reader is not None:
+        return load_tiled(filename, reader, area, options, cache)
+
+    image = Image.open(path)
+    orientation = exif.orientation(image)
+    size = tuple(box.oriented_size(image.size, orientation))
+    image_box = box.Box2D.scale_down(box.Size2D(*size), box.Size2D(*area))
+    # The display image is made as stored and turned upright once it is small
+    display_size = box.oriented_size(image_box.size, orientation)
+    if fast_preview and draft:
+        # Let the JPEG decoder skip detail using DCT scaling, decoding at 1/2,
+        # 1/4 or 1/8 scale as long as it is still bigger than the display.
+        # Does nothing for other formats.
+        draft_size = display_size
+        if cache is not None:
+            cache_box = box.Box2D.scale_down(
+                box.Size2D(*image.size),
+                box.Size2D(cache.resolution, cache.resolution),
+            )
+            draft_size = box.Size2D(
+                max(draft_size[0], cache_box.size[0]),
+                max(draft_size[1], cache_box.size[1]),
+            )
+        image.draft(image.mode, tuple(int(x) for x in draft_size))
+    with metrics.span("loader.decode"):
+        image.load()
+    decode_time = time.perf_counter() - start
+    logger.info(
+        "Decoded {} at {}x{} in {:.0f} ms".format(
+            filename, image.size[0], image.size[1], decode_time * 1000
+        )
+    )
+    if fast_preview:
+        display = exif.upright(
+            make_display_image(image, display_size, fast_preview, antialias),
+            orientation,
+        )
+        if cache is not None:
+            cache.put(path, size, image, orientation)
+        return LoadedImage(filename, size, None, display, area, options)
+
+    # Downsample from the nearest pyramid level rather than the full image.
+    # When prefetching, this also builds the levels in the background.
+    images = pyramid.ImagePyramid(image)
+    display = exif.upright(
+        make_display_image(
+            images.nearest(display_size), display_size, fast_preview, antialias
+        ),
+        orientation,
+    )
+    return LoadedImage(
+        filename,
+        size,
+        image,
+        display,
+        area,
+        options,
+        images,
+        orientation=orientation,
+    )
+
+
+class Prefetcher:
+    "Decodes the images around the current one in background threads"
+
+    def __init__(self, config, input_folder, images):
+        self.config = config
+        self.input_folder = input_folder
+        self.images = images
+        self.ahead = max(0, config.getint("gui", "prefetch_next"))
+        self.behind = max(0, config.getint("gui", "prefetch_previous"))
+
+        # Always keep room for the current image and all its neighbours
+        self.cache_size = max(
+            config.getint("gui", "prefetch_cache_size"), self.ahead + self.behind + 1
+        )
+        self.max_bytes = config.getint("gui", "max_cache_mb") * 1024 * 1024
+        self.current = None
+
+        # Images not to prefetch, e.g. duplicates being skipped
+        self.skip = set()
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, config.getint("gui", "prefetch_threads")),
+            thread_name_prefix="prefetch",
+        )
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.pending = {}
+        self.disk_cache = preview_cache.PreviewCache.from_config(config)
+
+        # (size, hash) of images hashed without being loaded, or None if they
+        # could not be read, and those being hashed, see hash_later()
+        self.hashed = {}
+        self.hashing = set()
+
+    def options(self):
+        return (
+            self.config.getboolean("gui", "fast_preview"),
+            self.config.getboolean("gui", "antialiase_slow_preview"),
+            self.config.getboolean("gui", "draft_decode"),
+            self.config.getfloat("cropall", "tiled_megapixels"),
+            self.config["selection"].get("suggest_crop", "center"),
+        )
+
+    def path(self, filename):
+        return os.path.join(self.input_folder, filename)
+
+    def cached(self, filename, area, options):
+        with self.lock:
+            loaded = self.cache.get(filename)
+            if loaded is not None and loaded.matches(area, options):
+                self.cache.move_to_end(filename)
+                return loaded
+        return None
+
+    def load(self, filename, area):
+        "Returns the LoadedImage for filename, decoding it now if it was not prefetched"
+        area = (int(area[0]), int(area[1]))
+        options = self.options()
+        self.current = filename
+        loaded = self.cached(filename, area, options)
+        if loaded is not None:
+            logger.debug("Prefetch hit {}".format(filename))
+            return loaded
+
+        with self.lock:
+            future = self.pending.get(filename)
+        if future is not None and not future.cancel():
+            # Already being decoded in the background; waiting is faster than
+            # starting again
+            loaded = future.result()
+            if loaded.matches(area, options):
+                self.store(loaded)
+                return loaded
+
+        loaded = load_image(
+            filename, self.path(filename), area, options, self.disk_cache
+        )
+        self.store(loaded)
+        return loaded
+
+    def known_hashes(self, filenames):
+        """Returns {filename: (size, hash)} of the images already hashed, with
+        None for those that could not be read, without waiting for any"""
+        results = {}
+        with self.lock:
+            for filename in filenames:
+                loaded = self.cache.get(filename)
+                if loaded is not None:
+                    results[filename] = (loaded.size, loaded.hash)
+                elif filename in self.hashed:
+                    results[filename] = self.hashed[filename]
+        return results
+
+    def hash_later(self, filenames):
+        """Hashes the images not hashed yet from a small decode in the prefetch
+        threads, for known_hashes()"""
+        import phash
+
+        known = self.known_hashes(filenames)
+        submitted = []
+        with self.lock:
+            for filename in filenames:
+                if filename in known or filename in self.hashing:
+                    continue
+                self.hashing.add(filename)
+                future = self.pool.submit(
+                    phash.hash_file,
+                    self.path(filename),
+                    self.config.getfloat("cropall", "tiled_megapixels"),
+                    self.disk_cache,
+                )
+                submitted.append((filename, future))
+        # Outside the lock, as the callback takes it, see prefetch()
+        for filename, future in submitted:
+            future.add_done_callback(partial(self.on_hashed, filename))
+
+    def on_hashed(self, filename, future):
+        if future.cancelled():
+            result = None
+        elif future.exception() is not None:
+            logger.warning("Failed to hash {}: {}".format(filename, future.exception()))
+            result = None
+        else:
+            result = future.result()
+        with self.lock:
+            self.hashing.discard(filename)
+            if not future.cancelled():
+                self.hashed[filename] = result
+
+    def prefetch(self, current, area):
+        "Queues decoding of the neighbours of images[current]"
+        if not self.images:
+            return
+        area = (int(area[0]), int(area[1]))
+        options = self.options()
+        count = len(self.images)
+        wanted = []
+        for step, number in ((1, self.ahead), (-1, self.behind)):
+            index = current
+            found = 0
+            for i in range(count):
+                if found == number:
+                    break
+                index = (index + step) % count
+                filename = self.images[index]
+                if filename in self.skip:
+                    continue
+                found += 1
+                if filename not in wanted:
+                    wanted.append(filename)
+
+        submitted = []
+        with self.lock:
+            # Assuming the neighbours are about the size of the current image,
+            # only prefetch as many as fit in max_cache_mb
+            current = self.cache.get(self.current)
+            if self.max_bytes and current is not None:
+                wanted = wanted[: max(0, self.max_bytes // current.nbytes() - 1)]
+
+            # Queued work that is no longer near the current image
+            stale = [
+                future
+                for filename, future in self.pending.items()
+                if filename not in wanted
+            ]
+
+            for filename in wanted:
+                loaded = self.cache.get(filename)
+                if loaded is not None and loaded.matches(area, options):
+                    continue
+                if filename in self.pending:
+                    continue
+                submitted.append((filename, self.submit(filename, area, options)))
+
+        # cancel() and add_done_callback() may call on_prefetched() right away
+        # on this thread, and it takes the lock, so both wait until it is
+        # released. A cancelled future is removed from pending by its callback.
+        for future in stale:
+            future.cancel()
+        for filename, future in submitted:
+            self.watch(filename, future)
+
+    def start(self, filename, area):
+        """Starts decoding filename in the background, e.g. the first image while
+        the window is still being created. Returns its future."""
+        area = (int(area[0]), int(area[1]))
+        with self.lock:
+            future = self.pending.get(filename)
+            if future is not None:
+                return future
+            future = self.submit(filename, area, self.options())
+        self.watch(filename, future)
+        return future
+
+    def submit(self, filename, area, options):
+        """Queues load_image() of filename. Must be called with the lock held,
+        and the future passed to watch() once it is released."""
+        future = self.pool.submit(
+            load_image,
+            filename,
+            self.path(filename),
+            area,
+            options,
+            self.disk_cache,
+        )
+        self.pending[filename] = future
+        return future
+
+    def watch(self, filename, future):
+        "Stores the result of a submitted future. Must be called without the lock."
+        future.add_done_callback(partial(self.on_prefetched, filename))
+
+    def on_prefetched(self, filename, future):
+        with self.lock:
+            if self.pending.get(filename) is future:
+                del self.pending[filename]
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logger.debug(
+                "Prefetching {} failed: {}".format(filename, future.exception())
+            )
+            return
+        self.store(future.result())
+
+    def store(self, loaded):
+        with self.lock:
+            self.cache[loaded.filename] = loaded
+            self.cache.move_to_end(loaded.filename)
+            self.evict()
+
+    def evict(self):
+        """Drops the least recently used images, except the current one, until
+        the cache is within prefetch_cache_size and max_cache_mb. Must be
+        called with the lock held."""
+        sizes = {filename: loaded.nbytes() for filename, loaded in self.cache.items()}
+        total = sum(sizes.values())
+        for filename in list(self.cache):
+            if len(self.cache) <= self.cache_size and (
+                not self.max_bytes or total <= self.max_bytes
+            ):
+                break
+            if filename == self.current:
+                continue
+            del self.cache[filename]
+            total -= sizes[filename]
+            logger.debug("Evicted {} from the image cache".format(filename))
+        logger.debug(
+            "Image cache holds {} images in {:.0f} MB".format(
+                len(self.cache), total / 1024 / 1024
+            )
+        )
+        if self.max_bytes and total > self.max_bytes:
+            logger.info(
+                "Image cache is over max_cache_mb holding only the current image"
+            )
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,128 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import logging
+import pathlib
+import threading
+
+logger = logging.getLogger("cropall")
+
+MANIFEST_NAME = "cropall_manifest.jsonl"
+
+
+def source_stat(src_file):
+    "Returns the source file properties recorded to detect changes"
+    stat = os.stat(src_file)
+    return {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def existing_outputs(output_folder):
+    """Returns the files in output_folder and its subfolders, relative to it
+    and using '/' like the manifest, for folders written before it existed"""
+    files = set()
+    for directory, subdirectories, filenames in os.walk(output_folder):
+        relative = os.path.relpath(directory, output_folder)
+        prefix = "" if relative == "." else pathlib.Path(relative).as_posix() + "/"
+        files.update(prefix + filename for filename in filenames)
+    return files
+
+
+class Manifest:
+    """An append-only JSON lines record of every image written to the output
+    folder, with its crop box, source file properties and output settings.
+    The last line for a file wins."""
+
+    def __init__(self, output_folder, path=None):
+        self.output_folder = pathlib.Path(output_folder)
+        self.path = pathlib.Path(path or self.output_folder / MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.exists = os.path.exists(self.path)
+        if self.exists:
+            self.load()
+
+    def load(self):
+        with open(self.path) as filehandle:
+            for line_number, line in enumerate(filehandle, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry["file"]] = entry
+                except (ValueError, KeyError):
+                    # E.g. a partial line if cropall was killed mid-write
+                    logger.warning(
+                        "Ignoring bad line {} in {}".format(line_number, self.path)
+                    )
+        logger.info("Read {} entries from {}".format(len(self.entries), self.path))
+
+    def key(self, dst_file):
+        "Returns the manifest name for dst_file, relative to the output folder"
+        return pathlib.Path(os.path.relpath(dst_file, self.output_folder)).as_posix()
+
+    def get(self, dst_file):
+        with self.lock:
+            return self.entries.get(self.key(dst_file))
+
+    def exported(self):
+        "Returns the set of output files written according to the manifest"
+        with self.lock:
+            return set(self.entries)
+
+    def boxes(self):
+        "Returns a mapping of output file to crop box for all crop entries"
+        with self.lock:
+            return {
+                name: entry["box"]
+                for name, entry in self.entries.items()
+                if entry.get("operation") == "crop"
+            }
+
+    def record(self, dst_file, operation, source, settings, box=None):
+        entry = {
+            "file": self.key(dst_file),
+            "operation": operation,
+            "source": source,
+            "settings": settings,
+        }
+        if box is not None:
+            entry["box"] = list(box)
+        line = json.dumps(entry, separators=(",", ":"))
+        with self.lock:
+            self.entries[entry["file"]] = entry
+            with open(self.path, "a") as filehandle:
+                filehandle.write(line + "\n")
+            self.exists = True
+
+    def is_current(self, dst_file, operation, source, settings, box=None, outputs=None):
+        """Returns True if dst_file was written from the same source, operation,
+        settings and box, and still exists. If the job writes other files, e.g.
+        renditions, give them as outputs to check those exist instead."""
+        entry = self.get(dst_file)
+        if entry is None:
+            return False
+        if box is not None:
+            box = list(box)
+        return (
+            entry.get("operation") == operation
+            and entry.get("source") == source
+            and entry.get("settings") == settings
+            and entry.get("box") == box
+            and all(os.path.exists(path) for path in outputs or [dst_file])
+        )
@@ -0,0 +1,209 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Timing spans for profiling a session with --profile. Spans are only recorded
+# once the registry is enabled, so they cost a flag check otherwise. Startup is
+# timed separately with a handful of milestones, reported with --startup-timing.
+
+import os
+import json
+import time
+import threading
+import functools
+import contextlib
+import collections
+
+Sample = collections.namedtuple("Sample", "name start duration pid tid")
+
+
+def percentile(values, fraction):
+    "Nearest rank percentile of already sorted values"
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Metrics:
+    "Collects the durations of named spans, and optionally a Chrome trace of them"
+
+    def __init__(self):
+        self.enabled = False
+        self.tracing = False
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.durations = collections.defaultdict(list)
+        self.events = []
+
+    def enable(self, trace=False):
+        self.enabled = True
+        self.tracing = trace
+
+    def record(self, sample):
+        "Adds a Sample, e.g. one measured in an export process by measure()"
+        with self.lock:
+            self.durations[sample.name].append(sample.duration)
+            if self.tracing:
+                self.events.append(sample)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        "Times the with block as name"
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(
+                Sample(
+                    name,
+                    start,
+                    time.perf_counter() - start,
+                    os.getpid(),
+                    threading.get_ident(),
+                )
+            )
+
+    def timed(self, name):
+        "Decorator that times each call of the function as name"
+
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.span(name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def summary(self):
+        "Returns {name: {count, total_ms, p50_ms, p95_ms, max_ms}}"
+        with self.lock:
+            durations = {
+                name: sorted(values) for name, values in self.durations.items()
+            }
+        return {
+            name: {
+                "count": len(values),
+                "total_ms": sum(values) * 1000,
+                "p50_ms": percentile(values, 0.5) * 1000,
+                "p95_ms": percentile(values, 0.95) * 1000,
+                "max_ms": values[-1] * 1000,
+            }
+            for name, values in sorted(durations.items())
+        }
+
+    def report(self):
+        "Returns the summary as a table"
+        lines = [
+            "{:<32} {:>7} {:>10} {:>9} {:>9} {:>9}".format(
+                "span", "count", "total ms", "p50 ms", "p95 ms", "max ms"
+            )
+        ]
+        for name, stats in self.summary().items():
+            lines.append(
+                "{:<32} {:>7} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                    name,
+                    stats["count"],
+                    stats["total_ms"],
+                    stats["p50_ms"],
+                    stats["p95_ms"],
+                    stats["max_ms"],
+                )
+            )
+        return "\n".join(lines)
+
+    def write_report(self, path):
+        with open(path, "w") as filehandle:
+            json.dump(
+                {
+                    "session_seconds": time.perf_counter() - self.origin,
+                    "spans": self.summary(),
+                },
+                filehandle,
+                indent=2,
+            )
+
+    def write_trace(self, path):
+        "Writes the spans in the Chrome trace event format, for chrome://tracing or Perfetto"
+        with self.lock:
+            events = list(self.events)
+        with open(path, "w") as filehandle:
+            json.dump(
+                {
+                    "traceEvents": [
+                        {
+                            "name": sample.name,
+                            "cat": "cropall",
+                            "ph": "X",
+                            "ts": (sample.start - self.origin) * 1e6,
+                            "dur": sample.duration * 1e6,
+                            "pid": sample.pid,
+                            "tid": sample.tid,
+                        }
+                        for sample in events
+                    ],
+                    "displayTimeUnit": "ms",
+                },
+                filehandle,
+            )
+
+
+def measure(name, function, *args):
+    """Calls function(*args) and returns its timing as a Sample, for running in
+    an export process where the registry is not shared. perf_counter() is
+    system wide on the supported platforms, so the start times line up."""
+    start = time.perf_counter()
+    function(*args)
+    return Sample(
+        name, start, time.perf_counter() - start, os.getpid(), threading.get_ident()
+    )
+
+
+class Milestones:
+    "Times since startup at which each named step finished"
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.marks = []
+
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
+
+    def report(self):
+        "Returns the milestones as a table of their time since startup and since the last one"
+        lines = ["{:<32} {:>10} {:>9}".format("startup", "since ms", "step ms")]
+        previous = self.origin
+        for name, at in self.marks:
+            lines.append(
+                "{:<32} {:>10.1f} {:>9.1f}".format(
+                    name, (at - self.origin) * 1000, (at - previous) * 1000
+                )
+            )
+            previous = at
+        return "\n".join(lines)
+
+
+registry = Metrics()
+span = registry.span
+timed = registry.timed
+
+# Started when cropall.py imports this module, before anything heavy
+startup = Milestones(registry.origin)
+mark = startup.mark
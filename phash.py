@@ -0,0 +1,76 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Perceptual hashes for finding runs of near identical images, e.g. burst and
+# studio shots. The difference hash (dHash) of an image is 64 bits, one for
+# each pair of neighbouring pixels of a 9x8 grey thumbnail, set if the left one
+# is brighter. Similar images have hashes that differ in only a few bits.
+
+import numpy as np
+from PIL import Image
+import box
+import exif
+import tiles
+
+HASH_SIZE = 8
+
+# Size to decode images at for hashing when they are not cached
+THUMBNAIL_SIZE = 64
+
+
+def dhash(image, size=HASH_SIZE):
+    "Returns the difference hash of a PIL image as an int of size * size bits"
+    grey = np.asarray(
+        image.convert("L").resize((size + 1, size), Image.BILINEAR), dtype=np.int16
+    )
+    bits = (grey[:, 1:] > grey[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def distance(a, b):
+    "Number of bits that differ between two hashes"
+    return bin(a ^ b).count("1")
+
+
+def thumbnail(path, tiled_megapixels=0, cache=None):
+    """Returns (source size, small image) of path, both upright, from the
+    preview cache if it has it, otherwise decoding at reduced scale where the
+    format allows"""
+    if cache is not None:
+        hit = cache.get(path)
+        if hit is not None:
+            return hit
+    size = (THUMBNAIL_SIZE, THUMBNAIL_SIZE)
+    reader = tiles.open_reader(path, tiled_megapixels)
+    if reader is not None:
+        orientation = reader.exif_orientation
+        with reader:
+            return tuple(box.oriented_size(reader.size, orientation)), exif.upright(
+                reader.overview(size), orientation
+            )
+    with Image.open(path) as image:
+        orientation = exif.orientation(image)
+        source_size = tuple(box.oriented_size(image.size, orientation))
+        image.draft("RGB", size)
+        image.thumbnail(size, Image.BILINEAR)
+        return source_size, exif.upright(image, orientation)
+
+
+def hash_file(path, tiled_megapixels=0, cache=None):
+    "Returns (source size, dhash) of the image at path"
+    size, image = thumbnail(path, tiled_megapixels, cache)
+    return size, dhash(image)
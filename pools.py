@@ -0,0 +1,33 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Process pools for work that must not hold up the GUI, such as exports and
+# hashing images for duplicates.
+
+import multiprocessing
+import concurrent.futures
+
+
+def process_pool(workers=0):
+    """Returns a ProcessPoolExecutor of workers processes, or one per core if
+    workers is 0 or less. Processes are spawned rather than forked, as the GUI
+    process has Tk and threads running, which a forked child would inherit
+    in a broken state."""
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers if workers > 0 else None,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
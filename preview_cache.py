@@ -0,0 +1,143 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import logging
+import hashlib
+import threading
+import exif
+from PIL import Image
+
+logger = logging.getLogger("cropall")
+
+
+class PreviewCache:
+    """Downscaled copies of source images kept on disk so revisiting a folder
+    does not decode everything again. Entries are keyed by the source path,
+    modification time and size, and the least recently used are deleted when
+    the cache grows past max_mb."""
+
+    def __init__(self, folder, max_mb, resolution):
+        self.folder = os.path.expanduser(folder)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.resolution = resolution
+        self.lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+        self.files = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.name.endswith(".jpg"):
+                    stat = entry.stat()
+                    self.files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        self.total = sum(size for mtime, size in self.files.values())
+
+    @staticmethod
+    def from_config(config):
+        "Returns a PreviewCache for the [gui] options, or None if it is disabled"
+        folder = config["gui"]["preview_cache"].strip()
+        if not folder:
+            return None
+        try:
+            return PreviewCache(
+                folder,
+                config.getint("gui", "preview_cache_mb"),
+                config.getint("gui", "preview_cache_resolution"),
+            )
+        except OSError as e:
+            logger.warning("Preview cache disabled: {}".format(e))
+            return None
+
+    def entry_path(self, path):
+        stat = os.stat(path)
+        # Previews are stored upright since EXIF orientation was handled
+        key = "{}\0{}\0{}\0{}\0upright".format(
+            os.path.abspath(path), stat.st_mtime_ns, stat.st_size, self.resolution
+        )
+        return os.path.join(
+            self.folder, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".jpg"
+        )
+
+    def get(self, path):
+        "Returns (source size, preview image) for path, or None if not cached"
+        entry = self.entry_path(path)
+        try:
+            image = Image.open(entry)
+            image.load()
+            width, height = map(int, image.info["comment"].split(b"x"))
+        except (OSError, KeyError, ValueError):
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+        with self.lock:
+            if entry in self.files:
+                self.files[entry] = (os.stat(entry).st_mtime_ns, self.files[entry][1])
+        return (width, height), image
+
+    def put(self, path, size, image, orientation=1):
+        """Stores a preview of image, which may already be downscaled, for path
+        with upright source size. The preview is turned upright for the EXIF
+        orientation once it is small."""
+        if image.mode not in ("RGB", "L"):
+            return
+        entry = self.entry_path(path)
+        # Resized straight from image, as a copy of it first would double the
+        # memory used by the huge images this cache helps most with
+        preview = image
+        scale = self.resolution / max(image.size)
+        if scale < 1:
+            preview = image.resize(
+                (
+                    max(1, round(image.size[0] * scale)),
+                    max(1, round(image.size[1] * scale)),
+                ),
+                Image.BILINEAR,
+                reducing_gap=2.0,
+            )
+        preview = exif.upright(preview, orientation)
+        temp = "{}.{}.tmp".format(entry, threading.get_ident())
+        comment = "{}x{}".format(*size).encode("ascii")
+        try:
+            preview.save(temp, "JPEG", quality=90, comment=comment)
+            os.replace(temp, entry)
+            stat = os.stat(entry)
+        except OSError as e:
+            logger.warning("Failed to write preview cache: {}".format(e))
+            return
+        with self.lock:
+            old = self.files.get(entry)
+            if old:
+                self.total -= old[1]
+            self.files[entry] = (stat.st_mtime_ns, stat.st_size)
+            self.total += stat.st_size
+            if self.total > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        "Deletes least recently used entries until the cache is 90% of max_bytes"
+        for entry, (mtime, size) in sorted(self.files.items(), key=lambda x: x[1][0]):
+            if self.total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(entry)
+            except OSError:
+                pass
+            del self.files[entry]
+            self.total -= size
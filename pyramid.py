@@ -0,0 +1,79 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+import threading
+
+
+def image_bytes(image):
+    "Approximate memory used by a decoded PIL image"
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+
+class ImagePyramid:
+    """Successively halved copies of an image, made on demand with
+    Image.reduce(2). Picking the smallest level that still has enough pixels
+    makes resizing for the display or preview cost about the same whatever the
+    source size. All levels together add a third to the base image's memory."""
+
+    def __init__(self, image, min_size=256):
+        self.levels = [image]
+        self.min_size = min_size
+        self.lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self.levels[0].size
+
+    def level(self, index):
+        "Returns level index, which is 1/2**index the base size, making it if needed"
+        with self.lock:
+            while len(self.levels) <= index:
+                last = self.levels[-1]
+                if min(last.size) < self.min_size * 2:
+                    break
+                self.levels.append(last.reduce(2))
+            return self.levels[min(index, len(self.levels) - 1)]
+
+    def select(self, box, size):
+        """Returns (image, box) for the smallest level whose copy of box, given
+        in base image coordinates, is at least size, and box in that level's
+        coordinates"""
+        width = box[2] - box[0]
+        height = box[3] - box[1]
+        scale = max(size[0] / max(width, 1), size[1] / max(height, 1))
+        index = max(0, int(math.floor(math.log2(1 / scale)))) if scale < 1 else 0
+        image = self.level(index)
+        if image is self.levels[0]:
+            return image, list(box)
+        scale_x = image.size[0] / self.size[0]
+        scale_y = image.size[1] / self.size[1]
+        return image, [
+            box[0] * scale_x,
+            box[1] * scale_y,
+            box[2] * scale_x,
+            box[3] * scale_y,
+        ]
+
+    def nearest(self, size):
+        "Returns the smallest level that is at least size"
+        return self.select((0, 0) + tuple(self.size), size)[0]
+
+    def nbytes(self):
+        "Approximate memory used by the levels"
+        with self.lock:
+            return sum(image_bytes(level) for level in self.levels)
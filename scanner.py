@@ -0,0 +1,130 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import queue
+import logging
+import threading
+import metrics
+
+logger = logging.getLogger("cropall")
+
+digits = re.compile(r"(\d+)")
+
+
+def natural_key(name):
+    "Sort key so that img2.jpg comes before img10.jpg"
+    return [
+        int(part) if part.isdigit() else part for part in digits.split(name.lower())
+    ]
+
+
+def scan_directories(folder, extensions, recursive=False, exclude=()):
+    """Yields a list of image filenames for each directory, relative to folder
+    and using '/' for subdirectories. Each directory is listed once with
+    os.scandir and its images are in natural order, before those of its
+    subdirectories. Directories in exclude, e.g. the output folder, are
+    skipped.
+
+    A directory is listed whole before any of it is yielded, so the first
+    image shown is the first in natural order. For a flat folder of 100k
+    files that costs under a second, mostly sorting, which is accepted over
+    showing an arbitrary image first."""
+    extensions = set(ext.lower() for ext in extensions)
+    exclude = set(os.path.normcase(os.path.abspath(path)) for path in exclude)
+    pending = [""]
+    while pending:
+        relative = pending.pop()
+        directory = os.path.join(folder, relative)
+        files = []
+        subdirectories = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    dot = entry.name.rfind(".")
+                    ext = entry.name[dot:].lower() if dot > 0 else None
+                    if ext in extensions and entry.is_file():
+                        files.append(entry.name)
+                    elif recursive and entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.name)
+        except OSError as e:
+            logger.warning("Failed to scan {}: {}".format(directory, e))
+            continue
+        prefix = relative + "/" if relative else ""
+        if files:
+            yield [prefix + name for name in sorted(files, key=natural_key)]
+
+        # Reversed as pending is a stack
+        for name in sorted(subdirectories, key=natural_key, reverse=True):
+            path = os.path.join(directory, name)
+            if os.path.normcase(os.path.abspath(path)) not in exclude:
+                pending.append(prefix + name)
+
+
+def scan_images(folder, extensions, recursive=False, exclude=()):
+    "Yields image filenames in the order of scan_directories()"
+    for images in scan_directories(folder, extensions, recursive, exclude):
+        yield from images
+
+
+class ImageScanner:
+    "Runs scan_directories() in a background thread, handing out images as they are found"
+
+    def __init__(self, folder, extensions, recursive=False, exclude=()):
+        self.args = (folder, extensions, recursive, exclude)
+        self.found = queue.Queue()
+        self.finished = threading.Event()
+        self.count = 0
+        self.thread = threading.Thread(target=self.run, name="scanner", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            with metrics.span("scanner.scan"):
+                for images in scan_directories(*self.args):
+                    logger.debug("Found {}".format(" ".join(images)))
+                    self.count += len(images)
+                    self.found.put(images)
+        finally:
+            self.finished.set()
+            logger.info("Found {} images".format(self.count))
+
+    def poll(self):
+        "Returns images found since the last call"
+        images = []
+        while True:
+            try:
+                images += self.found.get_nowait()
+            except queue.Empty:
+                return images
+
+    @metrics.timed("scanner.wait_for_first")
+    def wait_for_first(self):
+        "Blocks until the first images are found or the scan finishes, then returns them"
+        while not self.finished.is_set():
+            try:
+                return self.found.get(timeout=0.05) + self.poll()
+            except queue.Empty:
+                pass
+        return self.poll()
+
+    def done(self):
+        return self.finished.is_set() and self.found.empty()
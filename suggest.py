@@ -0,0 +1,149 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Suggests where to start the crop selection. An engine turns a small copy of
+# the display image into a map of how interesting each pixel is. The suggested
+# crop is the window of the selection's aspect ratio that holds the most of it,
+# traded off against the window's size. Engines are registered in ENGINES, so
+# more can be added with @engine("name").
+
+import numpy as np
+from PIL import Image
+
+# Width or height of the map the engines work on
+MAP_SIZE = 192
+
+# How much smaller crops are penalised. With 0.5, a crop half the image's area
+# must hold at least 75% of the energy to beat the whole image.
+TIGHTNESS = 0.5
+
+# Crop sizes tried, as fractions of the biggest crop of the aspect that fits
+SCALES = (1.0, 0.85, 0.7, 0.55, 0.4)
+
+ENGINES = {}
+
+
+def engine(name):
+    "Registers an energy map function of a float32 grey image in ENGINES"
+
+    def register(function):
+        ENGINES[name] = function
+        return function
+
+    return register
+
+
+def box_filter(values, radius):
+    "Mean of each (2 * radius + 1) square window, using a summed area table"
+    padded = np.pad(values, radius + 1, mode="edge")
+    table = padded.cumsum(0).cumsum(1)
+    size = 2 * radius + 1
+    sums = (
+        table[size:, size:]
+        - table[:-size, size:]
+        - table[size:, :-size]
+        + table[:-size, :-size]
+    )
+    return sums[: values.shape[0], : values.shape[1]] / (size * size)
+
+
+@engine("edges")
+def edge_energy(grey):
+    "Gradient magnitude, high on detail and outlines"
+    gx = np.zeros_like(grey)
+    gy = np.zeros_like(grey)
+    gx[:, 1:-1] = grey[:, 2:] - grey[:, :-2]
+    gy[1:-1, :] = grey[2:, :] - grey[:-2, :]
+    return box_filter(np.hypot(gx, gy), 2)
+
+
+@engine("entropy")
+def entropy_energy(grey, levels=16, radius=4):
+    "Local entropy of the grey levels, high on texture and low on flat areas"
+    quantized = np.minimum((grey * levels).astype(np.int32), levels - 1)
+    energy = np.zeros_like(grey)
+    for level in range(levels):
+        p = box_filter((quantized == level).astype(np.float32), radius)
+        energy -= p * np.log2(np.maximum(p, 1e-6))
+    return energy
+
+
+@engine("saliency")
+def saliency_energy(grey):
+    """Spectral residual saliency (Hou and Zhang 2007): what is left of the log
+    spectrum after removing its local average stands out to the eye"""
+    small = np.asarray(
+        Image.fromarray(grey).resize((64, 64), Image.BILINEAR), dtype=np.float32
+    )
+    spectrum = np.fft.fft2(small)
+    log_amplitude = np.log(np.abs(spectrum) + 1e-6)
+    residual = log_amplitude - box_filter(log_amplitude, 1)
+    saliency = np.abs(np.fft.ifft2(np.exp(residual + 1j * np.angle(spectrum)))) ** 2
+    saliency = box_filter(box_filter(saliency.astype(np.float32), 2), 2)
+    return np.asarray(
+        Image.fromarray(saliency).resize(grey.shape[::-1], Image.BILINEAR),
+        dtype=np.float32,
+    )
+
+
+def energy_map(image, name):
+    "Returns engine name's map of a PIL image, or None for 'center' or no engine"
+    if name not in ENGINES:
+        return None
+    small = image.convert("L")
+    small.thumbnail((MAP_SIZE, MAP_SIZE), Image.BILINEAR)
+    grey = np.asarray(small, dtype=np.float32) / 255
+    return ENGINES[name](grey).astype(np.float64)
+
+
+def best_window(energy, aspect):
+    """Returns the (left, upper, right, lower) window of aspect, as fractions of
+    the map size, that best balances holding energy against its area, or None
+    if the map is blank"""
+    height, width = energy.shape
+    table = np.zeros((height + 1, width + 1))
+    table[1:, 1:] = energy.cumsum(0).cumsum(1)
+    total = table[-1, -1]
+    if total <= 0:
+        return None
+    if width / height > aspect[0] / aspect[1]:
+        biggest = (height * aspect[0] / aspect[1], height)
+    else:
+        biggest = (width, width * aspect[1] / aspect[0])
+
+    best = None
+    for scale in SCALES:
+        w = max(1, min(width, round(biggest[0] * scale)))
+        h = max(1, min(height, round(biggest[1] * scale)))
+        sums = table[h:, w:] - table[:-h, w:] - table[h:, :-w] + table[:-h, :-w]
+
+        # Prefer the middle among equally good windows, e.g. on even textures
+        ys = np.arange(sums.shape[0]) - (height - h) / 2
+        xs = np.arange(sums.shape[1]) - (width - w) / 2
+        scores = sums / total - 1e-6 * np.hypot(ys[:, None], xs[None, :])
+        y, x = np.unravel_index(np.argmax(scores), scores.shape)
+        score = scores[y, x] - TIGHTNESS * (w * h) / (width * height)
+        if best is None or score > best[0]:
+            best = (score, x, y, w, h)
+
+    score, x, y, w, h = best
+    return (
+        float(x / width),
+        float(y / height),
+        float((x + w) / width),
+        float((y + h) / height),
+    )
@@ -0,0 +1,18 @@
+import sys
+import pathlib
+import configparser
+import pytest
+
+root = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root))
+
+
+@pytest.fixture
+def config():
+    "The default config, without the on disk caches or ImageMagick"
+    result = configparser.ConfigParser()
+    result.read(root / "cropall_default.ini")
+    result["gui"]["preview_cache"] = ""
+    result["gui"]["hash_index"] = ""
+    result["cropper"]["backend"] = "pillow"
+    return result
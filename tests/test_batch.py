@@ -0,0 +1,83 @@
+import json
+from PIL import Image
+import batch
+import manifest
+
+
+def make_images(folder, count=3):
+    folder.mkdir()
+    filenames = ["{}.jpg".format(i) for i in range(count)]
+    for i, filename in enumerate(filenames):
+        Image.new("RGB", (400, 300), (i * 60, 80, 160)).save(folder / filename)
+    return filenames
+
+
+def test_replay_jsonl_manifest(config, tmp_path):
+    "A manifest written by one run can be replayed into another output folder"
+    input_folder = tmp_path / "photos"
+    filenames = make_images(input_folder)
+    first = tmp_path / "first"
+    first.mkdir()
+    boxes = {filename: [10, 20, 210, 170] for filename in filenames}
+    assert batch.run(config, input_folder, first, boxes, workers=1) == 0
+
+    renamed = tmp_path / "session.jsonl"
+    renamed.write_text((first / manifest.MANIFEST_NAME).read_text())
+    for path in (first / manifest.MANIFEST_NAME, renamed):
+        assert batch.load_manifest(path) == boxes
+
+    second = tmp_path / "second"
+    second.mkdir()
+    replayed = batch.load_manifest(first / manifest.MANIFEST_NAME)
+    assert batch.run(config, input_folder, second, replayed, workers=1) == 0
+    for filename in filenames:
+        with Image.open(second / filename) as image:
+            assert image.size[0] * 150 == image.size[1] * 200
+
+
+def test_force_rewrites_existing_outputs(config, tmp_path, caplog):
+    input_folder = tmp_path / "photos"
+    filenames = make_images(input_folder)
+    output_folder = tmp_path / "crops"
+    output_folder.mkdir()
+    boxes = {filename: [0, 0, 200, 150] for filename in filenames}
+    config["cropper"]["confirm_overwrite"] = "True"
+    assert batch.run(config, input_folder, output_folder, boxes, workers=1) == 0
+
+    caplog.set_level("INFO", logger="cropall")
+    batch.run(config, input_folder, output_folder, boxes, workers=1)
+    assert "Exporting 0 images, 3 skipped" in caplog.text
+
+    caplog.clear()
+    before = [(output_folder / f).stat().st_mtime_ns for f in filenames]
+    batch.run(config, input_folder, output_folder, boxes, workers=1, force=True)
+    assert "Exporting 3 images, 0 skipped" in caplog.text
+    after = [(output_folder / f).stat().st_mtime_ns for f in filenames]
+    assert all(a > b for a, b in zip(after, before))
+
+    lines = (output_folder / manifest.MANIFEST_NAME).read_text().splitlines()
+    assert len(lines) == 6
+    assert all(json.loads(line)["box"] == [0, 0, 200, 150] for line in lines)
+
+
+def test_other_format_encoder_options_keep_exports_current(config, tmp_path, caplog):
+    "Only the encoder options of the formats written are part of the settings"
+    input_folder = tmp_path / "photos"
+    filenames = make_images(input_folder)
+    output_folder = tmp_path / "crops"
+    output_folder.mkdir()
+    boxes = {filename: [0, 0, 200, 150] for filename in filenames}
+    config["cropper"]["confirm_overwrite"] = "False"
+    assert batch.run(config, input_folder, output_folder, boxes, workers=1) == 0
+    line = (output_folder / manifest.MANIFEST_NAME).read_text().splitlines()[0]
+    assert list(json.loads(line)["settings"]["encoders"]) == ["JPEG"]
+
+    caplog.set_level("INFO", logger="cropall")
+    config["encoder.webp"]["quality"] = "50"
+    batch.run(config, input_folder, output_folder, boxes, workers=1)
+    assert "Exporting 0 images, 3 skipped" in caplog.text
+
+    caplog.clear()
+    config["encoder.jpeg"]["quality"] = "50"
+    batch.run(config, input_folder, output_folder, boxes, workers=1)
+    assert "Exporting 3 images, 0 skipped" in caplog.text
@@ -0,0 +1,36 @@
+from PIL import Image
+import cropper
+
+
+def test_failed_lossless_crop_falls_back(config, tmp_path, monkeypatch):
+    "A jpegtran error re-encodes the crop instead of failing the export"
+    jpegtran = tmp_path / "jpegtran"
+    jpegtran.write_text("#!/bin/sh\necho 'Unsupported marker' >&2\nexit 1\n")
+    jpegtran.chmod(0o755)
+    monkeypatch.setattr(cropper, "find_jpegtran", lambda: str(jpegtran))
+    Image.new("RGB", (640, 480), (40, 80, 120)).save(tmp_path / "a.jpg")
+    config["cropper"]["lossless_jpeg"] = "True"
+    config["cropper"]["resize"] = "False"
+    settings = cropper.Cropper(config).settings("crop")
+    cropper.crop_file(
+        tmp_path / "a.jpg", tmp_path / "out.jpg", [0, 0, 320, 240], settings
+    )
+    with Image.open(tmp_path / "out.jpg") as image:
+        assert image.size == (320, 240)
+
+
+def test_lossless_crop_checks_snapped_size(tmp_path, monkeypatch):
+    "A crop that only outgrows the resize bounds once snapped isn't lossless"
+    jpegtran = tmp_path / "jpegtran"
+    jpegtran.write_text("#!/bin/sh\ntouch {}\n".format(tmp_path / "ran"))
+    jpegtran.chmod(0o755)
+    monkeypatch.setattr(cropper, "find_jpegtran", lambda: str(jpegtran))
+    Image.new("RGB", (640, 480)).save(tmp_path / "a.jpg")
+    box = (8, 0, 328, 240)
+    assert not cropper.lossless_crop_file(
+        tmp_path / "a.jpg", tmp_path / "out.jpg", box, (320, 0)
+    )
+    assert not (tmp_path / "ran").exists()
+    assert cropper.lossless_crop_file(
+        tmp_path / "a.jpg", tmp_path / "out.jpg", box, (328, 0)
+    )
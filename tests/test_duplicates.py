@@ -0,0 +1,13 @@
+from PIL import Image
+import duplicates
+
+
+def test_empty_hash_index_is_not_saved(tmp_path, monkeypatch):
+    "An empty hash_index keeps hashes in memory and writes no file"
+    monkeypatch.chdir(tmp_path)
+    Image.new("RGB", (64, 48)).save(tmp_path / "a.png")
+    index = duplicates.HashIndex("")
+    index.put(tmp_path / "a.png", 0x1234)
+    assert index.get(tmp_path / "a.png") == 0x1234
+    index.save()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a.png"]
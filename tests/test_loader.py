@@ -0,0 +1,50 @@
+import threading
+from PIL import Image
+import loader
+
+
+def test_navigate_with_one_prefetch_thread(config, tmp_path):
+    "Cancelling and queueing prefetches must not deadlock on the prefetcher's lock"
+    images = ["{}.jpg".format(i) for i in range(8)]
+    for i, filename in enumerate(images):
+        Image.new("RGB", (640, 480), (i * 30, 100, 200)).save(tmp_path / filename)
+    config["gui"]["prefetch_threads"] = "1"
+    prefetcher = loader.Prefetcher(config, tmp_path, images)
+    area = (320, 240)
+    loaded = []
+
+    def navigate():
+        for index in range(6):
+            loaded.append(prefetcher.load(images[index], area))
+            prefetcher.prefetch(index, area)
+
+    thread = threading.Thread(target=navigate, daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive(), "navigation deadlocked"
+    prefetcher.pool.shutdown(wait=True, cancel_futures=True)
+    assert [image.filename for image in loaded] == images[:6]
+    assert loaded[0].size == (640, 480)
+
+
+def test_tiled_overview_covers_display_and_cache(tmp_path):
+    "The overview is big enough for the display even above the cache resolution"
+    import tiles
+
+    path = tmp_path / "huge.ppm"
+    Image.new("RGB", (3000, 2000), (10, 20, 30)).save(path)
+    cached = []
+
+    class Cache:
+        resolution = 500
+
+        def put(self, path, size, preview, orientation):
+            cached.append(preview.size)
+
+    reader = tiles.open_reader(path, 1)
+    loaded = loader.load_tiled(
+        "huge.ppm", reader, (1200, 800), (True, False, False, 1, "center"), Cache()
+    )
+    assert loaded.display.size == (1200, 800)
+    assert len(cached) == 1
+    assert cached[0][0] >= 1200 and cached[0][1] >= 800
@@ -0,0 +1,12 @@
+import manifest
+
+
+def test_existing_outputs_include_subfolders(tmp_path):
+    (tmp_path / "sub" / "deeper").mkdir(parents=True)
+    for name in ("a.jpg", "sub/b.jpg", "sub/deeper/c.jpg"):
+        (tmp_path / name).touch()
+    assert manifest.existing_outputs(tmp_path) == {
+        "a.jpg",
+        "sub/b.jpg",
+        "sub/deeper/c.jpg",
+    }
@@ -0,0 +1,44 @@
+import pytest
+from PIL import Image
+import tiles
+
+
+def test_decompression_bomb_limit_is_kept(tmp_path):
+    "Only opening an image in tiles lifts Pillow's limit, and only while it runs"
+    limit = Image.MAX_IMAGE_PIXELS
+    assert limit is not None
+    path = tmp_path / "huge.ppm"
+    Image.new("RGB", (4000, 3000), (10, 20, 30)).save(path)
+    try:
+        Image.MAX_IMAGE_PIXELS = 1000000
+        with tiles.open_reader(path, 1) as reader:
+            assert reader.size == (4000, 3000)
+            assert Image.MAX_IMAGE_PIXELS == 1000000
+            region = reader.read_region((0, 0, 64, 64))[0]
+            assert region.getpixel((0, 0)) == (10, 20, 30)
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+    assert Image.MAX_IMAGE_PIXELS == limit
+
+
+def test_single_strip_tiff_is_mapped(tmp_path):
+    "An uncompressed TIFF in one strip is memory mapped instead of decoded whole"
+    pytest.importorskip("tifffile")
+    path = tmp_path / "strip.tif"
+    image = Image.new("RGB", (300, 200), (10, 20, 30))
+    image.paste((200, 100, 50), (100, 50, 300, 200))
+    image.save(path)
+    with tiles.open_reader(path, 0.01) as reader:
+        assert isinstance(reader, tiles.RawReader)
+        region = reader.read_region((90, 40, 110, 60))[0]
+        assert region.getpixel((0, 0)) == (10, 20, 30)
+        assert region.getpixel((15, 15)) == (200, 100, 50)
+
+
+def test_large_compressed_strip_is_decoded_whole(tmp_path, monkeypatch):
+    "Compressed strips bigger than MAX_SEGMENT_BYTES aren't read in pieces"
+    pytest.importorskip("tifffile")
+    path = tmp_path / "deflate.tif"
+    Image.new("RGB", (300, 200)).save(path, compression="tiff_adobe_deflate")
+    monkeypatch.setattr(tiles, "MAX_SEGMENT_BYTES", 1024)
+    assert tiles.open_reader(path, 0.01) is None
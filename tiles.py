@@ -0,0 +1,438 @@
+# cropall: a tiny batch image processing app to crop pictures in less clicks
+#
+# Copyright (C) 2015-2024 Pyarelal Knowles
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reads regions of huge images without decoding them whole. TIFF and BigTIFF
+# files are read one tile or strip at a time with tifffile, if it is installed.
+# Uncompressed images that Pillow stores as a single raw block (BMP, PPM and
+# simple TIFFs) are memory mapped. Regions can be reduced by a power of two as
+# they are read, so memory scales with the size of the output, not the source.
+
+import math
+import mmap
+import logging
+import threading
+import functools
+import contextlib
+import numpy as np
+import exif
+from PIL import Image
+
+logger = logging.getLogger("cropall")
+
+TIFF_MAGIC = (b"II*\0", b"MM\0*", b"II+\0", b"MM\0+")
+
+MODES = {1: "L", 3: "RGB", 4: "RGBA"}
+
+# Largest compressed TIFF strip or tile to decode at once. Files with bigger
+# strips, e.g. a whole image in one strip, are decoded whole instead.
+MAX_SEGMENT_BYTES = 64 * 1024 * 1024
+
+
+# Threads inside unlimited_pixels() and Pillow's limit before the first one
+unlimited_lock = threading.Lock()
+unlimited_count = 0
+saved_max_pixels = None
+
+
+@contextlib.contextmanager
+def unlimited_pixels():
+    """Lifts Pillow's decompression bomb limit while the block opens an image
+    to be read a piece at a time, which would otherwise stop it being opened.
+    The limit is restored when the last thread leaves the block."""
+    global unlimited_count, saved_max_pixels
+    with unlimited_lock:
+        if unlimited_count == 0:
+            saved_max_pixels = Image.MAX_IMAGE_PIXELS
+            Image.MAX_IMAGE_PIXELS = None
+        unlimited_count += 1
+    try:
+        yield
+    finally:
+        with unlimited_lock:
+            unlimited_count -= 1
+            if unlimited_count == 0:
+                Image.MAX_IMAGE_PIXELS = saved_max_pixels
+
+
+def largest_power_of_two(value, limit):
+    "Returns the largest power of two that divides value and is at most limit"
+    step = 1
+    while step * 2 <= limit and value % (step * 2) == 0:
+        step *= 2
+    return step
+
+
+class TiledReader:
+    """Base class of the readers. Subclasses set size, mode and alignment, the
+    largest reduction that keeps their pieces aligned, and implement pieces()."""
+
+    path = None
+    size = (0, 0)
+    mode = "RGB"
+    alignment = 1
+
+    # How the stored pixels are turned upright, see exif.py
+    exif_orientation = 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def pieces(self, box):
+        "Yields (x, y, pixels) covering box, as uint8 arrays Image.fromarray() accepts"
+        raise NotImplementedError
+
+    def step(self, box, size):
+        "Returns the largest reduction of box that is still at least size"
+        scale = min(
+            (box[2] - box[0]) / max(1, size[0]), (box[3] - box[1]) / max(1, size[1])
+        )
+        return largest_power_of_two(self.alignment, max(1, scale))
+
+    def read_region(self, box, step=1):
+        """Returns (image, origin) where image is box reduced step times,
+        averaging each step x step block. The box is first moved up and left to
+        origin, a multiple of step, so that every piece reduces separately."""
+        left = box[0] - box[0] % step
+        upper = box[1] - box[1] % step
+        right = min(box[2], self.size[0])
+        lower = min(box[3], self.size[1])
+        region = Image.new(
+            self.mode,
+            (math.ceil((right - left) / step), math.ceil((lower - upper) / step)),
+        )
+        for x, y, pixels in self.pieces((left, upper, right, lower)):
+            piece = Image.fromarray(pixels, self.mode)
+            if step > 1:
+                piece = piece.reduce(step)
+            region.paste(piece, ((x - left) // step, (y - upper) // step))
+        return region, (left, upper)
+
+    def select(self, box, size):
+        """Returns (image, box) with at least size pixels of the box region, and
+        the box in the image's coordinates, like ImagePyramid.select()"""
+        step = self.step(box, size)
+        region, origin = self.read_region(box, step)
+        return region, [
+            (box[0] - origin[0]) / step,
+            (box[1] - origin[1]) / step,
+            (box[2] - origin[0]) / step,
+            (box[3] - origin[1]) / step,
+        ]
+
+    def overview(self, size):
+        "Returns the whole image reduced to no less than size"
+        box = (0, 0) + tuple(self.size)
+        return self.read_region(box, self.step(box, size))[0]
+
+
+class TiffReader(TiledReader):
+    "Decodes only the TIFF tiles or strips that intersect the requested region"
+
+    def __init__(self, path, tiff, page, levels=()):
+        self.path = path
+        self.tiff = tiff
+        self.page = page
+        self.levels = levels
+        self.lock = threading.Lock()
+        self.size = (page.imagewidth, page.imagelength)
+        # A second sample is alpha, which is dropped with the grey level kept
+        self.bands = 1 if page.samplesperpixel == 2 else page.samplesperpixel
+        self.mode = MODES[self.bands]
+        if page.is_tiled:
+            self.segment = (page.tilewidth, page.tilelength)
+            self.alignment = largest_power_of_two(
+                math.gcd(page.tilewidth, page.tilelength), 256
+            )
+        else:
+            rows = min(page.rowsperstrip or page.imagelength, page.imagelength)
+            self.segment = (page.imagewidth, rows)
+            self.alignment = largest_power_of_two(rows, 256)
+        self.across = math.ceil(self.size[0] / self.segment[0])
+        self.exif_orientation = tiff_orientation(page)
+
+    @classmethod
+    def supports(cls, page):
+        return (
+            page.imagedepth == 1
+            and segment_bytes(page) <= MAX_SEGMENT_BYTES
+            and page.planarconfig == 1
+            and page.dtype in (np.uint8, np.uint16)
+            and page.samplesperpixel in (1, 2, 3, 4)
+            and (
+                page.photometric in (0, 1, 2)
+                or (page.photometric == 6 and page.compression == 7)
+            )
+        )
+
+    def close(self):
+        self.tiff.close()
+
+    def decode(self, index):
+        with self.lock:
+            count = self.page.databytecounts[index]
+            if not count:
+                return None
+            handle = self.tiff.filehandle
+            handle.seek(self.page.dataoffsets[index])
+            data = handle.read(count)
+        segment = self.page.decode(data, index, jpegtables=self.page.jpegtables)[0]
+        if segment is None:
+            return None
+        pixels = segment.reshape(segment.shape[-3:])
+        if pixels.dtype == np.uint16:
+            pixels = (pixels >> 8).astype(np.uint8)
+        if self.page.photometric == 0:
+            pixels = 255 - pixels
+        return pixels[:, :, 0] if self.bands == 1 else pixels
+
+    def pieces(self, box):
+        width, height = self.segment
+        for row in range(box[1] // height, math.ceil(box[3] / height)):
+            for column in range(box[0] // width, math.ceil(box[2] / width)):
+                pixels = self.decode(row * self.across + column)
+                if pixels is None:
+                    continue
+                x = column * width
+                y = row * height
+                left = max(box[0], x)
+                upper = max(box[1], y)
+                right = min(box[2], x + pixels.shape[1])
+                lower = min(box[3], y + pixels.shape[0])
+                if right > left and lower > upper:
+                    yield left, upper, np.ascontiguousarray(
+                        pixels[upper - y : lower - y, left - x : right - x]
+                    )
+
+    def overview(self, size):
+        "Uses the smallest pyramid level stored in the file that is at least size"
+        for level in reversed(self.levels[1:]):
+            if level.size[0] >= size[0] and level.size[1] >= size[1]:
+                return level.overview(size)
+        return super().overview(size)
+
+
+class RawReader(TiledReader):
+    "Memory maps an uncompressed image and reads it in horizontal bands"
+
+    # Largest band to copy out of the mapping at once
+    BAND_BYTES = 16 * 1024 * 1024
+
+    # Pillow raw modes that can be mapped, and the order to take their bytes in
+    RAWMODES = {
+        "L": ("L", 1, [0]),
+        "RGB": ("RGB", 3, [0, 1, 2]),
+        "BGR": ("RGB", 3, [2, 1, 0]),
+        "RGBX": ("RGB", 4, [0, 1, 2]),
+        "BGRX": ("RGB", 4, [2, 1, 0]),
+        "RGBA": ("RGBA", 4, [0, 1, 2, 3]),
+        "BGRA": ("RGBA", 4, [2, 1, 0, 3]),
+    }
+
+    def __init__(self, path, size, offset, rawmode, stride, orientation):
+        self.path = path
+        self.mode, self.bands, self.order = self.RAWMODES[rawmode]
+        self.size = size
+        self.stride = stride or size[0] * self.bands
+        self.band = largest_power_of_two(256, max(1, self.BAND_BYTES // self.stride))
+        self.alignment = self.band
+        self.orientation = orientation
+        self.offset = offset
+        with open(path, "rb") as handle:
+            self.map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pixels = np.frombuffer(
+            self.map, np.uint8, size[1] * self.stride, offset
+        ).reshape(size[1], self.stride)
+
+    # TIFF (photometric, samples per pixel) that map to a raw mode
+    TIFF_RAWMODES = {(1, 1): "L", (2, 3): "RGB", (2, 4): "RGBA"}
+
+    @classmethod
+    def open_tiff(cls, page, path):
+        """Returns a reader for an uncompressed 8 bit tifffile page stored as
+        one block, e.g. in a single strip, or None"""
+        rawmode = cls.TIFF_RAWMODES.get((page.photometric, page.samplesperpixel))
+        if (
+            rawmode is None
+            or page.compression != 1
+            or page.planarconfig != 1
+            or page.imagedepth != 1
+            or page.bitspersample != 8
+            or not page.is_contiguous
+        ):
+            return None
+        size = (page.imagewidth, page.imagelength)
+        reader = cls(path, size, page.dataoffsets[0], rawmode, 0, 1)
+        reader.exif_orientation = tiff_orientation(page)
+        return reader
+
+    @classmethod
+    def open(cls, image, path):
+        "Returns a reader for the Pillow image opened from path, or None"
+        if len(image.tile) != 1:
+            return None
+        tile = image.tile[0]
+        args = tile[3] if isinstance(tile[3], tuple) else (tile[3], 0, 1)
+        size = tuple(exif.stored_size(image))
+        if (
+            tile[0] != "raw"
+            or tuple(tile[1]) != (0, 0) + size
+            or args[0] not in cls.RAWMODES
+        ):
+            return None
+        reader = cls(path, size, tile[2], *args[:3])
+        reader.exif_orientation = exif.stored_orientation(image)
+        return reader
+
+    def close(self):
+        self.pixels = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def pieces(self, box):
+        for upper in range(box[1], box[3], self.band):
+            lower = min(upper + self.band, box[3])
+            if self.orientation < 0:
+                rows = self.pixels[self.size[1] - lower : self.size[1] - upper][::-1]
+            else:
+                rows = self.pixels[upper:lower]
+            rows = rows[:, box[0] * self.bands : box[2] * self.bands]
+            pixels = rows.reshape(lower - upper, box[2] - box[0], self.bands)
+            pixels = pixels[:, :, self.order]
+            if self.mode == "L":
+                pixels = pixels[:, :, 0]
+            pixels = np.array(pixels)
+            if self.orientation < 0:
+                self.release(self.size[1] - lower, self.size[1] - upper)
+            else:
+                self.release(upper, lower)
+            yield box[0], upper, pixels
+
+    def release(self, first, last):
+        """Drops the mapped pages of rows first to last once they are copied
+        out, so reading the whole image doesn't keep all of it resident"""
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        start = self.offset + first * self.stride
+        start -= start % mmap.PAGESIZE
+        end = self.offset + last * self.stride
+        self.map.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+
+@functools.lru_cache(maxsize=None)
+def load_tifffile():
+    "Returns the tifffile module, or None if it is not installed"
+    # Imported on the first TIFF rather than at startup, as it is slow to import
+    try:
+        import tifffile
+    except ImportError:
+        return None
+    return tifffile
+
+
+def tiff_orientation(page):
+    "Returns the EXIF orientation of a tifffile page"
+    orientation = page.tags.get(exif.TAG)
+    if orientation is not None and orientation.value in exif.TRANSPOSES:
+        return orientation.value
+    return 1
+
+
+def segment_bytes(page):
+    "Returns the decoded size of a tifffile page's largest tile or strip"
+    if page.is_tiled:
+        width, height = page.tilewidth, page.tilelength
+    else:
+        width = page.imagewidth
+        height = min(page.rowsperstrip or page.imagelength, page.imagelength)
+    return width * height * page.samplesperpixel * page.dtype.itemsize
+
+
+def is_tiff(path):
+    with open(path, "rb") as handle:
+        return handle.read(4) in TIFF_MAGIC
+
+
+def open_tiff(path, min_pixels):
+    """Returns a reader for path, False if it is too small, or None if it
+    can't be read in pieces. Uncompressed images are memory mapped, others
+    are read a tile or strip at a time."""
+    tiff = load_tifffile().TiffFile(path)
+    try:
+        pages = [level.keyframe for level in tiff.series[0].levels]
+        if pages[0].imagewidth * pages[0].imagelength < min_pixels:
+            tiff.close()
+            return False
+        raw = RawReader.open_tiff(pages[0], path)
+        if raw is not None:
+            tiff.close()
+            return raw
+        if not all(TiffReader.supports(page) for page in pages):
+            tiff.close()
+            return None
+        levels = [TiffReader(path, tiff, page) for page in pages]
+    except Exception:
+        tiff.close()
+        raise
+    levels[0].levels = levels
+    return levels[0]
+
+
+def open_reader(path, min_megapixels):
+    """Returns a reader for path if it has at least min_megapixels and can be
+    read in pieces, otherwise None, meaning it should be decoded whole"""
+    if not min_megapixels:
+        return None
+    min_pixels = min_megapixels * 1e6
+    try:
+        if is_tiff(path) and load_tifffile() is not None:
+            reader = open_tiff(path, min_pixels)
+            if reader is False:
+                return None
+            if reader is not None:
+                return reader
+        with unlimited_pixels(), Image.open(path) as image:
+            if image.size[0] * image.size[1] < min_pixels:
+                return None
+            reader = RawReader.open(image, path)
+        if reader is None:
+            logger.warning(
+                "{} has no tiles{}, it will be decoded whole".format(
+                    path,
+                    " (install tifffile to read TIFFs in tiles)"
+                    if image.format == "TIFF" and load_tifffile() is None
+                    else "",
+                )
+            )
+        return reader
+    except Exception as e:
+        logger.warning("Failed to open {} in tiles: {}".format(path, e))
+        return None
+
+
+def crop(reader, box, size):
+    "Returns the box region of reader resized to size"
+    image, region = reader.select(box, size)
+    if image.size == tuple(size) and region == [0, 0] + list(size):
+        return image
+    return image.resize(tuple(size), Image.LANCZOS, box=tuple(region))